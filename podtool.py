@@ -8,22 +8,94 @@
 #
 # Copyright 2006 Ben Buxton <bb at cactii dot(.) net>
 
+import time
+startTime = time.time()
 import os, os.path
-import gpod
 import statvfs
 import tempfile
 import re
 import sys
 from optparse import OptionParser
-import eyed3
-import eyed3.mp3
-import eyed3.id3
-import imghdr
-import shutil
-import time
 import stat
-import hashlib
 import struct
+import bisect
+import cPickle
+import errno
+import atexit
+try:
+  from scandir import scandir
+except ImportError: # No scandir module, make do with listdir and stat
+  class DirEntry:
+    def __init__(self, dir, name):
+      self.name = name
+      self.path = os.path.join(dir, name)
+    def stat(self):
+      return os.stat(self.path)
+    def is_dir(self):
+      return os.path.isdir(self.path)
+    def is_file(self):
+      return os.path.isfile(self.path)
+  def scandir(dir):
+    return [DirEntry(dir, name) for name in os.listdir(dir)]
+import threading
+import Queue
+
+# Stands in for a module until it's first used, so a command only pays
+# for importing what it needs. Submodules listed in also are imported
+# with it. An optional module is false if it can't be imported.
+class LazyModule:
+    def __init__(self, name, also=(), optional=False):
+        self.__dict__.update(name=name, also=also, optional=optional,
+                             module=None, missing=False)
+
+    def load(self):
+        if self.module is None and not self.missing:
+            start = time.time()
+            try:
+                module = __import__(self.name)
+                for sub in self.also:
+                    __import__(sub)
+            except ImportError:
+                if not self.optional:
+                    raise
+                self.__dict__["missing"] = True
+                return None
+            self.__dict__["module"] = module
+            timing("import %s" % self.name, start)
+        return self.module
+
+    def __getattr__(self, attr):
+        module = self.load()
+        if module is None:
+            raise AttributeError(attr)
+        return getattr(module, attr)
+
+    def __nonzero__(self):
+        return self.load() is not None
+
+gpod = LazyModule("gpod")
+eyed3 = LazyModule("eyed3", ("eyed3.mp3", "eyed3.id3"))
+imghdr = LazyModule("imghdr")
+shutil = LazyModule("shutil")
+hashlib = LazyModule("hashlib")
+numpy = LazyModule("numpy", optional=True) # Else SPLs are left to libgpod
+fcntl = LazyModule("fcntl")
+array = LazyModule("array")         # Snapshots
+mmap = LazyModule("mmap")           # ItdbFile
+socket = LazyModule("socket")       # serve and -d
+json = LazyModule("json")
+traceback = LazyModule("traceback")
+
+# Time taken by each startup step, for --timings
+timings = []
+
+def timing(what, start):
+  timings.append((what, time.time() - start))
+
+def reportTimings():
+  for what, secs in timings:
+    sys.stderr.write("%8.1f ms  %s\n" % (secs * 1000, what))
+  sys.stderr.write("%8.1f ms  total\n" % ((time.time() - startTime) * 1000))
 
 mountpoint = "/mnt/ipod" # Ipod mount point
 dotitdb = os.path.join(os.environ['HOME'],".gtkpod")
@@ -60,43 +132,285 @@ def validFiles(files):
       fls.append(file)
   return fls
 
+# Per-file results cached in dotitdb/<name> across runs, keyed by file
+# identity (device, inode, size, mtime) so a file is only looked at
+# again once it changes. Subclasses provide parse(file).
+class FileCache:
+    def __init__(self, name):
+        self.file = os.path.join(dotitdb, name)
+        self.entries = None # identity -> (path, value)
+        self.paths = {}     # path -> identity
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.lock.acquire()
+        try:
+            if self.entries is None:
+                entries = {}
+                try:
+                    f = open(self.file, "rb")
+                    entries = cPickle.load(f)
+                    f.close()
+                except:
+                    Msg("DEBUG: No %s, will create" % self.file, 2)
+                for key, (path, value) in entries.items():
+                    self.paths[path] = key
+                self.entries = entries
+        finally:
+            self.lock.release()
+
+    def key(self, file):
+        try:
+            st = os.stat(file)
+        except (OSError, TypeError):
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def has(self, file):
+        if self.entries is None:
+            self.load()
+        return self.entries.has_key(self.key(file))
+
+    # Safe to call from several threads; files are parsed outside the
+    # lock, so two of them may parse the same file
+    def get(self, file):
+        if self.entries is None:
+            self.load()
+        key = self.key(file)
+        if not key:
+            return None
+        entry = self.entries.get(key)
+        if entry:
+            return entry[1]
+        value = self.parse(file)
+        self.lock.acquire()
+        try:
+            old = self.paths.get(file)
+            if old and old != key:
+                self.entries.pop(old, None)
+            self.entries[key] = (file, value)
+            self.paths[file] = key
+            self.dirty = True
+        finally:
+            self.lock.release()
+        return value
+
+    # Drop entries for files which have gone away or changed
+    def evict(self):
+        if self.entries is None:
+            self.load()
+        self.lock.acquire()
+        try:
+            for key, (path, value) in self.entries.items():
+                if self.key(path) != key:
+                    del self.entries[key]
+                    if self.paths.get(path) == key:
+                        del self.paths[path]
+                    self.dirty = True
+        finally:
+            self.lock.release()
+
+    def save(self):
+        if dryRun or not self.dirty or not os.path.isdir(dotitdb):
+            return
+        self.lock.acquire()
+        try:
+            Msg("DEBUG: Writing %s, %d entries" % (self.file, len(self.entries)), 2)
+            f = open(self.file + ".new", "wb")
+            cPickle.dump(self.entries, f, 2)
+            f.close()
+            os.rename(self.file + ".new", self.file)
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+# Cache of parsed id3 tags. get() returns a dict with 'mp3' and
+# 'tagged' set, plus the tag fields and 'art', the md5 of the embedded
+# jpeg artwork (or None).
+class TagCache(FileCache):
+    def __init__(self):
+        FileCache.__init__(self, "tagcache")
+
+    def parse(self, file):
+        Msg("DEBUG: Reading tags from %s" % file, 2)
+        info = {'mp3': False, 'tagged': False, 'art': None}
+        if not eyed3.mp3.isMp3File(file):
+            return info
+        info['mp3'] = True
+        try:
+            audioFile = eyed3.mp3.Mp3AudioFile(file, eyed3.id3.ID3_ANY_VERSION)
+        except:
+            return info
+        tag = audioFile.tag
+        if not tag:
+            return info
+        info['tagged'] = True
+        info['title'] = str(tag.title)
+        info['artist'] = str(tag.artist)
+        info['album'] = str(tag.album)
+        info['genre'] = str(tag.genre)
+        # br = audioFile.bit_rate_str() #broken
+        info['bitrate'] = 128
+        #info['tracklen'] = audioFile.getPlayTime() * 1000 #broken
+        info['tracklen'] = 300000
+        for img in tag.images:
+            if imghdr.what(None, img.imageData) == "jpeg":
+                info['art'] = hashlib.md5(img.imageData).hexdigest()
+            break
+        return info
+
+# Cache of whole file SHA1s, see fileDigest()
+class DigestCache(FileCache):
+    def __init__(self):
+        FileCache.__init__(self, "digestcache")
+
+    def parse(self, file):
+        Msg("DEBUG: Hashing all of %s" % file, 2)
+        return fileDigest(file)
+
+# Cache of fileHash()es. prefetch() hashes a batch of files on a pool
+# of threads, each holding at most one file open at a time.
+class HashCache(FileCache):
+    def __init__(self, jobs):
+        FileCache.__init__(self, "hashcache")
+        self.jobs = max(1, jobs)
+
+    def parse(self, file):
+        Msg("DEBUG: Hashing %s" % file, 2)
+        return fileHash(file)
+
+    def prefetch(self, files):
+        todo = Queue.Queue()
+        for file in files:
+            if file and not self.has(file):
+                todo.put(file)
+        if todo.empty():
+            return
+        Msg("DEBUG: Hashing %d files" % todo.qsize(), 2)
+        workers = []
+        for i in range(min(self.jobs, todo.qsize())):
+            t = threading.Thread(target=self.work, args=(todo,))
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+
+    def work(self, todo):
+        while True:
+            try:
+                file = todo.get_nowait()
+            except Queue.Empty:
+                return
+            self.get(file)
+
+# Content addressed cache of extracted artwork in dotitdb/artwork, one
+# <md5>.jpg per distinct image however many tracks share it. Kept under
+# limit bytes by dropping the least recently used files, file mtimes
+# record when a thumbnail was last handed out.
+class ArtCache:
+    def __init__(self, limit):
+        self.dir = os.path.join(dotitdb, "artwork")
+        self.limit = limit
+
+    def get(self, digest):
+        path = os.path.join(self.dir, digest + ".jpg")
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, digest, data):
+        if not os.path.isdir(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                if not os.path.isdir(self.dir): # Lost a race with a worker
+                    raise
+        fd, tmp = tempfile.mkstemp(".tmp", "", self.dir)
+        os.write(fd, data)
+        os.close(fd)
+        path = os.path.join(self.dir, digest + ".jpg")
+        os.rename(tmp, path)
+        return path
+
+    # Evict least recently used thumbnails. Only call once the itdbs
+    # referring to them have been written.
+    def trim(self):
+        if dryRun or not os.path.isdir(self.dir):
+            return
+        files = []
+        total = 0
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.limit:
+                break
+            os.unlink(path)
+            total -= size
+        Msg("DEBUG: Artwork cache holds %d Mb" % (total/1024/1024), 2)
+
+# Scan the iPod's Music/Fnn directories. Returns the set of lowercased
+# file paths. Listings are remembered in dotitdb/ipodscan so directories
+# whose mtime hasn't changed since the last scan aren't read again.
+def scanMusicDir(musicDir):
+  scanFile = os.path.join(dotitdb, "ipodscan")
+  try:
+    sf = open(scanFile, "rb")
+    cache = cPickle.load(sf)
+    sf.close()
+  except:
+    cache = {}
+  newcache = {}
+  files = set()
+  for entry in scandir(musicDir):
+    if not entry.is_dir():
+      continue
+    mtime = entry.stat().st_mtime
+    if cache.has_key(entry.path) and cache[entry.path][0] == mtime:
+      names = cache[entry.path][1]
+    else:
+      Msg("DEBUG: Scanning %s" % entry.path, 2)
+      names = [e.name for e in scandir(entry.path) if e.is_file()]
+    newcache[entry.path] = (mtime, names)
+    for name in names:
+      files.add(os.path.join(entry.path, name).lower())
+  if not dryRun and os.path.isdir(dotitdb):
+    sf = open(scanFile + ".new", "wb")
+    cPickle.dump(newcache, sf, 2)
+    sf.close()
+    os.rename(scanFile + ".new", scanFile)
+  return files
+
 # Given an mp3 file, extracts thumbnail and returns the filename
-# Filename is basically <file_mdsum>.jpg
+# Filename is basically <image_md5sum>.jpg in the artwork cache
 def thumbfile(file):
-  global tmpDir
   global dryRun
-  if dryRun or not eyed3.mp3.isMp3File(file):
+  if dryRun:
+    return None
+  info = tagCache.get(file)
+  if not info or not info['art']: # Not an mp3 or no usable artwork
     return None
+  thumb = artCache.get(info['art'])
+  if thumb: # Already extracted for this or another track
+    return thumb
   try:
     audioFile = eyed3.mp3.Mp3AudioFile(file, eyed3.id3.ID3_ANY_VERSION)
   except:
     return None
-  tag = audioFile.tag
-  images = tag.images
-  if not tmpDir:
-    tmpDir = tempfile.mkdtemp()
-  for img in images:
-    try:
-      imgFile = img.getDefaultFileName(str(1))
-      img.writeFile(tmpDir, imgFile)
-      imgFile = os.path.join(tmpDir, imgFile)
-    except:
-      continue
-    f = open(os.path.join(imgFile), "rb")
-    m = hashlib.md5()
-    while True:
-      d = f.read(8096)
-      if not d: break
-      m.update(d)
-    f.close()
-    fnam = m.hexdigest() + ".jpg"
-    f2 = os.path.join(tmpDir, fnam)
-    if imghdr.what(imgFile) == "jpeg" and not os.path.isfile(f2):
-      os.rename (imgFile, f2)
-    else:
-      Msg("DEBUG: %s doesn't appear to be a jpeg file, ignoring" % imgFile, 2)
-      os.unlink(imgFile)
-    return f2
+  for img in audioFile.tag.images:
+    data = img.imageData
+    if imghdr.what(None, data) != "jpeg":
+      Msg("DEBUG: Artwork in %s doesn't appear to be a jpeg file, ignoring" % file, 2)
+      return None
+    return artCache.put(hashlib.md5(data).hexdigest(), data)
+  return None
 
 # Returns bytes free space on filesystem at (dir)
 def diskFree(dir):
@@ -108,6 +422,15 @@ def diskSpace(dir):
   fs_stat = os.statvfs(dir)
   return fs_stat[statvfs.F_BSIZE] * fs_stat[statvfs.F_BLOCKS]
 
+# Returns the allocation unit of filesystem at (dir), which allocates
+# whole clusters (FAT reports them as its block size)
+def clusterSize(dir):
+  return os.statvfs(dir)[statvfs.F_BSIZE] or 1
+
+# Returns space taken by a file of size bytes in clusters of cluster bytes
+def diskUsage(cluster, size):
+  return (size + cluster - 1) / cluster * cluster
+
 # Get size of file on disk
 def fileSize(file):
   try:
@@ -116,6 +439,13 @@ def fileSize(file):
     return 0
   return file_stat[stat.ST_SIZE] # Get filesize
 
+# Report how long a phase of a command took for n items,
+# returns the start time for the next phase
+def phaseDone(name, start, n):
+  now = time.time()
+  Msg("INFO: %s: %d in %.2fs" % (name, n, now - start), 1)
+  return now
+
 # Print messages, if we are verbose enough
 def Msg(msg, level):
   global verbose
@@ -151,91 +481,172 @@ def askIfOk(msg):
   print "Aborting..."
   sys.exit(0)
 
+# The ipod <-> local map, kept in dotitdb/map as "<local>;<ipod>" lines.
+# saved holds the map as last written (local -> ipod path). Each run
+# builds the new map from scratch with set()/remove(), indexed both
+# ways so removal is O(1). Changes are appended to map.journal as they
+# happen and commit() atomically replaces the map file, then drops the
+# journal. If a run dies before committing, the next load() replays its
+# journal over the saved map, so tracks copied before the crash stay
+# mapped.
+class MapStore:
+    def __init__(self):
+        self.file = os.path.join(dotitdb, "map")
+        self.journalFile = self.file + ".journal"
+        self.saved = {}
+        self.map = {} # local path -> ipod path
+        self.rev = {} # ipod path -> local path
+        self.journal = None
+
+    def load(self):
+        self.saved = {}
+        self.map = {}
+        self.rev = {}
+        Msg("DEBUG: Reading ipod map file", 2)
+        try:
+            mf = open(self.file, "r")
+            for line in mf:
+                line_split = line.rstrip("\n").split(";")
+                if len(line_split) != 2 or not line_split[0] or not line_split[1]:
+                    continue
+                self.saved[line_split[0]] = line_split[1]
+            mf.close()
+        except IOError:
+            Msg("DEBUG: No map file, will create later", 2)
+        try:
+            jf = open(self.journalFile, "r")
+        except IOError:
+            return
+        replayed = 0
+        saverev = dict([(i, l) for l, i in self.saved.items()])
+        for line in jf:
+            line = line.rstrip("\n")
+            if line[:1] == "+" and line.count(";") == 1:
+                lfile, ifile = line[1:].split(";")
+                if saverev.has_key(ifile):
+                    del self.saved[saverev[ifile]]
+                self.saved[lfile] = ifile
+                saverev[ifile] = lfile
+            elif line[:1] == "-" and saverev.has_key(line[1:]):
+                lfile = saverev.pop(line[1:])
+                if self.saved.get(lfile) == line[1:]:
+                    del self.saved[lfile]
+            else:
+                continue # Torn last line
+            replayed += 1
+        jf.close()
+        if replayed:
+            Msg("WARN: Recovered %d map changes from an unfinished run" % replayed, 1)
+
+    def log(self, line):
+        if dryRun:
+            return
+        if not self.journal:
+            if not os.path.isdir(dotitdb):
+                return
+            self.journal = open(self.journalFile, "a")
+        self.journal.write(line + "\n")
+        self.journal.flush()
+
+    def set(self, lfile, ifile):
+        if self.map.get(lfile) == ifile:
+            return
+        if self.map.has_key(lfile):
+            del self.rev[self.map[lfile]]
+        if self.rev.has_key(ifile):
+            del self.map[self.rev[ifile]]
+        self.map[lfile] = ifile
+        self.rev[ifile] = lfile
+        self.log("+%s;%s" % (lfile, ifile))
+
+    # Carries over a saved entry that still holds, without journaling it
+    def keep(self, lfile, ifile):
+        self.map[lfile] = ifile
+        self.rev[ifile] = lfile
+
+    def remove(self, ifile):
+        if not self.rev.has_key(ifile):
+            return
+        del self.map[self.rev.pop(ifile)]
+        self.log("-%s" % ifile)
+
+    def commit(self):
+        if dryRun:
+            Msg("DEBUG: Not writing ipod map file (dry-run)", 2)
+            return
+        Msg("DEBUG: Writing ipod map file", 2)
+        mf = open(self.file + ".new", "w")
+        for l, i in self.map.items():
+            mf.write("%s;%s\n" % (l, i))
+        mf.flush()
+        os.fsync(mf.fileno())
+        mf.close()
+        os.rename(self.file + ".new", self.file)
+        self.saved = dict(self.map)
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.journalFile):
+            os.unlink(self.journalFile)
+
 # Read ipod -> local track map file
-# Fills ipodMap[] where key = ipod id, value = local id
-# Terrible code, needs a bit cleanup
+# Fills ipodMap[] where key = ipod id, value = local id, and keeps the
+# entries whose tracks are still on both sides for writeMap()
 def readMap():
   global ipodMap
-  global ipodMapNew
   global l_itdb
   global i_itdb
-  ipodMapNew = {}
   ipodMap[0] = 0
-  iMap = {}
-  lMap = {}
-  podMap = {}
-  locMap = {}
-  lfmap = {}
-  ifmap = {}
-  mapFile = os.path.join(dotitdb, "map")
-  Msg("DEBUG: Reading ipod map file", 2)
-  try:
-    mf = file(mapFile, "r")
-  except:
-    Msg("DEBUG: No map file, will create later", 2)
-    return None
-  for line in mf.readlines():
-    line = line.strip()
-    line_split = line.split(";")
-    if len(line_split) != 2:
-        continue
-    (localFile,ipodFile) = line.split(";")
-    if not localFile or not ipodFile:
-      continue
-    iMap[ipodFile] = localFile
-    lMap[localFile] = ipodFile
-    lfmap[line] = localFile
-    ifmap[line] = ipodFile
-  mf.close()
-  for track in gpod.sw_get_tracks(i_itdb):
-    path = str(track.ipod_path)
-    if iMap.has_key(path):
-      podMap[path] = track.id
-  for track in gpod.sw_get_tracks(l_itdb):
-    path = str(track.ipod_path)
-    if lMap.has_key(path):
-      locMap[path] = track.id
-  for f in lfmap.keys():
-    lf = lfmap[f]
-    i_f = ifmap[f]
-    if not podMap.has_key(i_f) or not locMap.has_key(lf):
-      continue
-    podid = int(podMap[ifmap[f]])
-    locid = int(locMap[lfmap[f]])
-    ipodMap[podid] = locid
-  for t in gpod.sw_get_tracks(i_itdb):
+  mapStore.load()
+  podMap = {} # ipod path -> ipod id
+  for track in itdbTracks(i_itdb):
+    podMap[str(track.ipod_path)] = track.id
+  for track in itdbTracks(l_itdb):
+    ifile = mapStore.saved.get(str(track.ipod_path))
+    if ifile and podMap.has_key(ifile):
+      ipodMap[int(podMap[ifile])] = int(track.id)
+      mapStore.keep(str(track.ipod_path), ifile)
+  for t in itdbTracks(i_itdb):
     if not ipodMap.has_key(t.id):
       ipodMap[t.id] = 0
 
 # Sets ipod map. Takes local track and ipod track as arg
 def setMap(ltrack, itrack):
-  global ipodMapNew
   lfile = ltrack.ipod_path
   ifile = itrack.ipod_path
   if lfile and ifile:
-    ipodMapNew[lfile] = ifile
+    mapStore.set(str(lfile), str(ifile))
 
-# Deletes ipod track 'id' from map
+# Deletes ipod track from map
 def delMap(track):
-  global ipodMapNew
-  for t in ipodMapNew.keys():
-    if ipodMapNew[t] == str(track.ipod_path):
-      del ipodMapNew[t]
-      return
+  mapStore.remove(str(track.ipod_path))
 
 # Write new ipodmap to file
 def writeMap():
-  global ipodMapNew
-  global dryRun
+  mapStore.commit()
+
+# Read the check manifest: local file -> (size, mtime, hash) as last
+# verified by the check command
+def readManifest():
+  try:
+    mf = open(os.path.join(dotitdb, "manifest"), "rb")
+    manifest = cPickle.load(mf)
+    mf.close()
+  except:
+    Msg("DEBUG: No check manifest, checking everything", 2)
+    return {}
+  return manifest
+
+def writeManifest(manifest):
   if dryRun:
-    Msg("DEBUG: Not writing ipod map file (dry-run)", 2)
+    Msg("DEBUG: Not writing check manifest (dry-run)", 2)
     return
-  Msg("DEBUG: Writing ipod map file", 2)
-  mapFile = os.path.join(dotitdb, "map")
-  mf = file(mapFile, "w")
-  for l in ipodMapNew.keys():
-    mf.write("%s;%s\n" % (str(l),str(ipodMapNew[l])))
+  Msg("DEBUG: Writing check manifest", 2)
+  manifestFile = os.path.join(dotitdb, "manifest")
+  mf = open(manifestFile + ".new", "wb")
+  cPickle.dump(manifest, mf, 2)
   mf.close()
+  os.rename(manifestFile + ".new", manifestFile)
 
 # Hash of a file, as used by gtkpod extended info file
 # Combination of size and first 16k of file for speed
@@ -245,106 +656,241 @@ def fileHash(filename):
   sha1 = hashlib.sha1()
   size = os.path.getsize(filename)
   sha1.update(struct.pack("<L", size))
-  sha1.update(open(filename).read(16384))
+  f = open(filename, "rb")
+  sha1.update(f.read(16384))
+  f.close()
   return sha1.hexdigest()
 
-# Write the gtkpod extended info file
+# Extended info for the local db, gtkpod's <dbname>.ext. Records are
+# kept per track id in <ext>.idx, with changes made through extSet()
+# and friends appended to <ext>.journal, so routine commands only write
+# the records they changed. Once the journal grows, it is compacted
+# into a new index on a background thread (the interpreter waits for
+# it before exiting). The gtkpod text file is only written by export(),
+# and is re-imported if something else (gtkpod) rewrote it since.
+class ExtStore:
+    def __init__(self, extFile):
+        self.text = extFile
+        self.idx = extFile + ".idx"
+        self.journalFile = extFile + ".journal"
+        self.records = {}
+        self.textStamp = None
+        self.journal = None
+        self.pending = 0 # Journal entries not in the index yet
+        self.rebuild = False
+        self.compactor = None
+
+    def stamp(self, file):
+        try:
+            st = os.stat(file)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def load(self):
+        self.records.clear()
+        self.pending = 0
+        self.rebuild = False
+        stamp = self.stamp(self.text)
+        try:
+            f = open(self.idx, "rb")
+            self.textStamp, records = cPickle.load(f)
+            f.close()
+        except:
+            records = None
+        if records is not None and (stamp is None or stamp == self.textStamp):
+            self.records.update(records)
+            for journal in (self.journalFile + ".old", self.journalFile):
+                self.replay(journal)
+            return
+        if stamp:
+            Msg("DEBUG: Importing extended info file %s" % self.text, 2)
+            self.importText()
+        else:
+            Msg("WARN: No extended info file, will create.", 2)
+        self.textStamp = stamp
+        self.rebuild = True
+
+    def importText(self):
+        sum = hashCache.get(options.dbname)
+        ef = open(self.text, "r")
+        for line in ef.readlines():
+            bits = line.strip().split("=", 1)
+            if len(bits) != 2:
+                continue
+            key, val = bits
+            if key == "ituneddb_hash":
+                if val != sum:
+                    Msg("WARN: Checksum for itdb doesn't match", 1)
+            elif key == "id":
+                chunk_id = val
+                if chunk_id != "xxx":
+                    self.records[int(chunk_id)] = {}
+            elif key in ("filename_ipod", "filename_locale", "md5_hash"):
+                self.records[int(chunk_id)][key] = val
+        ef.close()
+
+    def replay(self, journal):
+        try:
+            jf = open(journal, "r")
+        except IOError:
+            return
+        for line in jf:
+            if not line.endswith("\n"):
+                break # Torn last line
+            bits = line[:-1].split("\t", 2)
+            id = int(bits[0])
+            if len(bits) == 3:
+                self.records.setdefault(id, {})[bits[1]] = bits[2]
+            elif len(bits) == 2 and self.records.has_key(id):
+                self.records[id].pop(bits[1], None)
+            elif len(bits) == 1:
+                self.records.pop(id, None)
+            self.pending += 1
+        jf.close()
+
+    def log(self, *bits):
+        self.pending += 1
+        if dryRun:
+            return
+        if not self.journal:
+            if not os.path.isdir(os.path.dirname(self.journalFile)):
+                return
+            self.journal = open(self.journalFile, "a")
+        self.journal.write("\t".join([str(b) for b in bits]) + "\n")
+        self.journal.flush()
+
+    # Make the journal durable
+    def sync(self):
+        if self.journal:
+            os.fsync(self.journal.fileno())
+
+    def set(self, id, attr, value):
+        if self.records.get(id, {}).get(attr) == value:
+            return
+        self.records.setdefault(id, {})[attr] = value
+        self.log(id, attr, value)
+
+    def unset(self, id, attr):
+        if self.records.has_key(id) and self.records[id].has_key(attr):
+            del self.records[id][attr]
+            self.log(id, attr)
+
+    def drop(self, id):
+        if self.records.has_key(id):
+            del self.records[id]
+            self.log(id)
+
+    # Flush the journal, compacting it once it's a quarter of the index
+    # or the index needs rebuilding after an import
+    def save(self):
+        if dryRun:
+            return
+        if self.journal:
+            self.sync()
+            self.journal.close()
+            self.journal = None
+        if self.rebuild or self.pending > max(1000, len(self.records) / 4):
+            self.compact()
+
+    def compact(self):
+        if self.compactor:
+            self.compactor.join()
+        if os.path.exists(self.journalFile):
+            os.rename(self.journalFile, self.journalFile + ".old")
+        snapshot = (self.textStamp, dict([(k, dict(v)) for k, v in self.records.items()]))
+        self.pending = 0
+        self.rebuild = False
+        self.compactor = threading.Thread(target=self.writeIndex, args=(snapshot,))
+        self.compactor.start()
+
+    def writeIndex(self, snapshot):
+        Msg("DEBUG: Compacting extended info, %d tracks" % len(snapshot[1]), 2)
+        f = open(self.idx + ".new", "wb")
+        cPickle.dump(snapshot, f, 2)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(self.idx + ".new", self.idx)
+        if os.path.exists(self.journalFile + ".old"):
+            os.unlink(self.journalFile + ".old")
+
+    # Write the gtkpod compatible text file for tracks in itdb
+    def export(self, itdb):
+        sum = hashCache.get(options.dbname)
+        ef = open(self.text, "w")
+        ef.write("itunesdb_hash=%s\n" % sum)
+        ef.write("version=0.99.1\n")
+        count = 0
+        for track in gpod.sw_get_tracks(itdb):
+            id = track.id
+            ef.write("id=%d\n" % id)
+            info = self.records.get(id, {})
+            for key in ("filename_ipod", "filename_utf8", "filename_locale", "md5_hash"):
+                if info.has_key(key):
+                    ef.write("%s=%s\n" % (key, info[key]))
+            ef.write("transferred=1\n")
+            count += 1
+        ef.write("id=xxx\n")
+        ef.close()
+        self.textStamp = self.stamp(self.text)
+        self.compact()
+        return count
+
+# Update the extended info for the local db, hashing tracks which have
+# no hash yet (or all of them if forceHash), and save it. forceHash
+# also exports the gtkpod extended info file.
 def writeExt(forceHash):
   global l_itdb
   global dryRun
   global extInfo
-  extFile = options.dbname + ".ext"
   s = Spinner()
-  sum = fileHash(options.dbname)
-  if not dryRun:
-    ef = file(extFile, "w")
-    ef.write("itunesdb_hash=%s\n" % sum)
-    ef.write("version=0.99.1\n")
+  if forceHash:
+    hashCache.prefetch([str(t.ipod_path) for t in gpod.sw_get_tracks(l_itdb)])
   count = 0
   for track in gpod.sw_get_tracks(l_itdb):
     id = track.id
     s.Print()
-    if not dryRun:
-      ef.write("id=%d\n" % id)
-      if not extInfo.has_key(id):
-        extInfo[id] = {}
-        extInfo[id]['filename_locale'] = track.ipod_path
-      if extInfo[id].has_key("filename_ipod"):
-        ef.write("filename_ipod=%s\n" % extInfo[id]['filename_ipod'])
-      if extInfo[id].has_key("filename_utf8"):
-        ef.write("filename_utf8=%s\n" % extInfo[id]['filename_utf8'])
-      if extInfo[id].has_key("filename_locale"):
-        ef.write("filename_locale=%s\n" % extInfo[id]['filename_locale'])
-      if extInfo[id].has_key("md5_hash") and not forceHash:
-        ef.write("md5_hash=%s\n" % extInfo[id]['md5_hash'])
-      else:
-        hash = fileHash(extInfo[id]['filename_locale'])
-        if len(hash) == 40:
-          Msg("DEBUG: Hashed %s" % extInfo[id]['filename_locale'], 2)
-          if not dryRun:
-            ef.write("md5_hash=%s\n" % hash)
-      ef.write("transferred=1\n")
+    if not extInfo.has_key(id):
+      extSet(id, 'filename_locale', track.ipod_path)
+    if forceHash or not extInfo[id].has_key("md5_hash"):
+      hash = hashCache.get(extInfo[id].get('filename_locale'))
+      if hash and len(hash) == 40:
+        extSet(id, "md5_hash", hash)
     count += 1
   s.Done()
-  if not dryRun:
-    ef.write("id=xxx\n")
-    ef.close()
+  if dryRun:
+    Msg( "Didnt write extended info, %d tracks (dryRun)" % count, 2)
+    return
+  if forceHash:
+    extStore.export(l_itdb)
     Msg( "Wrote extended file, %d tracks" % count, 2)
-  else:
-    Msg( "Didnt write extended file, %d tracks (dryRun)" % count, 2)
+  extStore.save()
+  hashCache.save()
 
-# Read the extended info file from gtkpod
+# Read the extended info for the local db
 def readExt(extFile):
   global l_itdb
   global dryRun
   global extInfo
-  sum = fileHash(options.dbname)
-
-  if os.path.isfile(extFile):
-    ef = file(extFile, "r")
-    for line in ef.readlines():
-      bits = line.strip().split("=", 1)
-      key,val = bits
-      if key == "version": continue
-      elif key == "ituneddb_hash":
-        if val != sum:
-          Msg("WARN: Checksum for itdb doesn't match", 1)
-      elif key == "id":
-        chunk_id = val
-        if chunk_id != "xxx":
-          extInfo[int(chunk_id)] = {}
-      elif key == "filename_ipod":
-        chunk_fn = val
-        extInfo[int(chunk_id)]['filename_ipod'] = chunk_fn
-      elif key == "filename_locale":
-        chunk_fn = val
-        extInfo[int(chunk_id)]['filename_locale'] = chunk_fn
-      elif key == "md5_hash":
-        chunk_fn = val
-        extInfo[int(chunk_id)]['md5_hash'] = chunk_fn
-    ef.close()
-  else:
-    Msg("WARN: No extended info file, will create.", 2)
+  extStore.load()
   for t in gpod.sw_get_tracks(l_itdb):
     if not extInfo.has_key(t.id):
-      extInfo[t.id] = {}
-      extInfo[t.id]['filename_locale'] = t.ipod_path
+      extSet(t.id, 'filename_locale', t.ipod_path)
     elif not extInfo[t.id].has_key("filename_locale"):
-      extInfo[t.id]["filename_locale"] = t.ipod_path
+      extSet(t.id, "filename_locale", t.ipod_path)
     elif not len(t.ipod_path):
       t.ipod_path = extInfo[t.id]["filename_locale"]
-    
+
 def extDel(id, attr):
-  global extInfo
-  if extInfo.has_key(id):
-    if extInfo[id].has_key(attr):
-      del extInfo[id][attr]
+  extStore.unset(id, attr)
 
 def extSet(id, attr, value):
-  global extInfo
-  if not extInfo.has_key(id):
-    extInfo[id] = {}
-  extInfo[id][attr] = value
+  extStore.set(id, attr, value)
+
+# Forget all extended info for track id
+def extDrop(id):
+  extStore.drop(id)
 
 # Shifts arg parameters by one (ie strip "ipod" entry)
 def argShift(arg):
@@ -362,7 +908,7 @@ def copySPLs(itdb1, itdb2):
     if not pl.is_spl:
       continue
     newpl = gpod.itdb_playlist_duplicate(pl)
-    gpod.itdb_playlist_add(itdb2, newpl, -1)
+    playlistAdd(itdb2, newpl, -1)
     plMap[newpl.id] = pl.id
     Msg("INFO: Copied playlist '%s'" % newpl.name, 1)
     gpod.itdb_spl_update(newpl)
@@ -433,8 +979,412 @@ def argLen(arg, n):
   if len(arg) < n:
     showhelp()
 
-# Find tracks that match given pattern
-# Pattern is one of:
+# Read-only stand-ins for an itdb: Snapshot and ItdbFile
+class ReadOnlyItdb:
+    # {id: (tracks, bytes, msecs)} for each playlist, like playlistStats()
+    def playlistStats(self):
+        stats = {}
+        for pl in self.playlists:
+            size = length = 0
+            for t in pl.tracks:
+                size += t.size
+                length += t.tracklen
+            stats[pl.id] = (len(pl.tracks), size, length)
+        return stats
+
+# Track and playlist of a Snapshot
+class SnapTrack:
+    pass
+
+class SnapPlaylist:
+    def __init__(self, id, name, is_spl, tracks):
+        self.id = id
+        self.name = name
+        self.is_spl = is_spl
+        self.tracks = tracks
+
+# Read-only copy of an itdb's tracks and playlists, written next to it
+# by writeSnapshot() so that list, diff and 'playlist list' can answer
+# without libgpod. Track fields are packed arrays, strings index into a
+# string table. Stands in for the itdb through itdbTracks(),
+# itdbPlaylists() and playlistTracks().
+class Snapshot(ReadOnlyItdb):
+    version = 2
+    strings = ("title", "artist", "album", "genre", "ipod_path")
+    ints = ("id", "rating", "playcount", "time_added", "time_played",
+            "mark_unplayed", "bookmark_time", "bitrate", "size", "tracklen")
+
+    def __init__(self, data):
+        self.id = data["id"]
+        strings = data["strings"].split("\0")
+        cols = []
+        for field in self.strings:
+            col = array.array("i")
+            col.fromstring(data["cols"][field])
+            cols.append((field, [strings[i] for i in col]))
+        for field in self.ints:
+            col = array.array("l")
+            col.fromstring(data["cols"][field])
+            cols.append((field, col))
+        self.tracks = []
+        for row in xrange(data["count"]):
+            t = SnapTrack()
+            for field, col in cols:
+                setattr(t, field, col[row])
+            self.tracks.append(t)
+        self.playlists = []
+        self.stats = {}
+        for id, name, is_spl, packed, stats in data["playlists"]:
+            rows = array.array("i")
+            rows.fromstring(packed)
+            tracks = [self.tracks[row] for row in rows]
+            self.playlists.append(SnapPlaylist(id, name, is_spl, tracks))
+            self.stats[id] = stats
+
+    def playlistStats(self):
+        return self.stats
+
+# Track of an ItdbFile, an mhit chunk. Fields are read from the mapped
+# file the first time they're used, strings from the mhit's mhods.
+class ItdbTrack:
+    # field -> (offset in mhit, struct format)
+    ints = {"id": (16, "<I"), "visible": (20, "<I"), "compilation": (30, "B"),
+            "rating": (31, "B"), "time_modified": (32, "<I"),
+            "size": (36, "<I"), "tracklen": (40, "<I"), "track_nr": (44, "<I"),
+            "year": (52, "<I"), "bitrate": (56, "<I"), "samplerate": (62, "<H"),
+            "playcount": (80, "<I"), "time_played": (88, "<I"),
+            "cd_nr": (92, "<I"), "time_added": (104, "<I"),
+            "bookmark_time": (108, "<I"), "checked": (120, "B"),
+            "BPM": (122, "<H"), "mark_unplayed": (178, "B")}
+    # field -> mhod type
+    strings = {"title": 1, "ipod_path": 2, "album": 3, "artist": 4,
+               "genre": 5, "filetype": 6, "comment": 8, "composer": 12,
+               "grouping": 13}
+    # Timestamps, stored as seconds since 1904 and returned as time_t
+    # like libgpod does (0 stays 0)
+    times = ("time_modified", "time_played", "time_added")
+
+    def __init__(self, db, off):
+        self.db = db
+        self.off = off
+
+    def __getattr__(self, name):
+        db = self.db
+        if name in self.ints:
+            off, fmt = self.ints[name]
+            if off + struct.calcsize(fmt) > db.u32(self.off + 4):
+                value = 0 # Older, shorter mhit
+            else:
+                value = struct.unpack_from(fmt, db.map, self.off + off)[0]
+            if value and name in self.times:
+                value -= 2082844800
+        elif name in self.strings:
+            if not self.__dict__.has_key("mhods"):
+                self.mhods = db.mhods(self.off)
+            value = None
+            if self.mhods.has_key(self.strings[name]):
+                value = db.string(self.mhods[self.strings[name]])
+        else:
+            raise AttributeError(name)
+        self.__dict__[name] = value
+        return value
+
+# Read-only view of an iTunesDB file, parsed without libgpod. The file
+# is mapped and only the chunk headers are walked up front (mhbd, mhsd,
+# mhlt/mhit for tracks, mhlp/mhyp/mhip for playlists); track fields
+# are decoded as they're used. Raises ValueError if the file isn't an
+# iTunesDB it understands.
+class ItdbFile(ReadOnlyItdb):
+    def __init__(self, file):
+        f = open(file, "rb")
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.tracks = []
+        self.playlists = []
+        members = [] # (id, name, is_spl, track ids) for each playlist
+        self.expect(0, "mhbd")
+        self.id = struct.unpack_from("<Q", self.map, 24)[0]
+        off = self.u32(4)
+        for i in xrange(self.u32(20)):
+            self.expect(off, "mhsd")
+            type = self.u32(off + 12)
+            if type == 1:
+                self.readTracks(off + self.u32(off + 4))
+            elif type == 2:
+                members = self.readPlaylists(off + self.u32(off + 4))
+            off += self.u32(off + 8)
+        byId = dict([(t.id, t) for t in self.tracks])
+        for id, name, is_spl, ids in members:
+            tracks = [byId[tid] for tid in ids if byId.has_key(tid)]
+            self.playlists.append(SnapPlaylist(id, name, is_spl, tracks))
+
+    def u32(self, off):
+        return struct.unpack_from("<I", self.map, off)[0]
+
+    def expect(self, off, tag):
+        if self.map[off:off+4] != tag:
+            raise ValueError("expected %s at 0x%x" % (tag, off))
+
+    def readTracks(self, off):
+        self.expect(off, "mhlt")
+        n = self.u32(off + 8)
+        off += self.u32(off + 4)
+        for i in xrange(n):
+            self.expect(off, "mhit")
+            self.tracks.append(ItdbTrack(self, off))
+            off += self.u32(off + 8)
+
+    def readPlaylists(self, off):
+        self.expect(off, "mhlp")
+        n = self.u32(off + 8)
+        off += self.u32(off + 4)
+        playlists = []
+        for i in xrange(n):
+            self.expect(off, "mhyp")
+            end = off + self.u32(off + 8)
+            id = struct.unpack_from("<Q", self.map, off + 28)[0]
+            name = None
+            is_spl = False
+            ids = []
+            child = off + self.u32(off + 4)
+            while child < end:
+                tag = self.map[child:child+4]
+                if tag == "mhod":
+                    type = self.u32(child + 12)
+                    if type == 1:
+                        name = self.string(child)
+                    elif type in (50, 51): # Smart playlist prefs/rules
+                        is_spl = True
+                elif tag == "mhip":
+                    ids.append(self.u32(child + 24))
+                else:
+                    raise ValueError("unexpected %r at 0x%x" % (tag, child))
+                child += self.u32(child + 8)
+            playlists.append((id, name, is_spl, ids))
+            off = end
+        return playlists
+
+    # {mhod type: offset} of the mhods of the mhit at off
+    def mhods(self, off):
+        ret = {}
+        child = off + self.u32(off + 4)
+        for i in xrange(self.u32(off + 12)):
+            self.expect(child, "mhod")
+            ret.setdefault(self.u32(child + 12), child)
+            child += self.u32(child + 8)
+        return ret
+
+    # The string held by the string mhod at off, as UTF-8
+    def string(self, off):
+        length = self.u32(off + 28)
+        data = self.map[off+40:off+40+length]
+        if self.u32(off + 24) == 2:
+            return data
+        return data.decode("utf-16-le").encode("utf-8")
+
+def itdbTracks(itdb):
+  if isinstance(itdb, ReadOnlyItdb):
+    return itdb.tracks
+  return gpod.sw_get_tracks(itdb)
+
+def itdbPlaylists(itdb):
+  if isinstance(itdb, ReadOnlyItdb):
+    return itdb.playlists
+  return gpod.sw_get_playlists(itdb)
+
+def playlistTracks(pl):
+  if isinstance(pl, SnapPlaylist):
+    return pl.tracks
+  return gpod.sw_get_playlist_tracks(pl)
+
+def localSnapFile():
+  return options.dbname + ".snap"
+
+# Snapshot of the iPod itdb, taken when sync backs it up
+def ipodSnapFile():
+  return os.path.join(dotitdb, "iTunesDB.ipod.snap")
+
+# SHA1 of a whole file
+def fileDigest(file):
+  sha1 = hashlib.sha1()
+  f = open(file, "rb")
+  while True:
+    data = f.read(1048576)
+    if not data:
+      break
+    sha1.update(data)
+  f.close()
+  return sha1.hexdigest()
+
+# Write a Snapshot of itdb to snapFile, for as long as source keeps the
+# same contents. If there's a local copy of source, it's hashed instead.
+def writeSnapshot(itdb, snapFile, source, copy=None):
+  if dryRun:
+    return
+  Msg("DEBUG: Writing snapshot %s" % snapFile, 2)
+  tracks = list(gpod.sw_get_tracks(itdb))
+  rows = dict([(t.id, row) for row, t in enumerate(tracks)])
+  strings = []
+  table = {}
+  cols = {}
+  for field in Snapshot.strings:
+    col = array.array("i")
+    for t in tracks:
+      value = str(getattr(t, field) or "")
+      if not table.has_key(value):
+        table[value] = len(strings)
+        strings.append(value)
+      col.append(table[value])
+    cols[field] = col.tostring()
+  for field in Snapshot.ints:
+    cols[field] = array.array("l", [int(getattr(t, field) or 0) for t in tracks]).tostring()
+  playlists = []
+  for pl in gpod.sw_get_playlists(itdb):
+    plrows = array.array("i")
+    size = length = 0
+    for t in gpod.sw_get_playlist_tracks(pl):
+      if rows.has_key(t.id):
+        plrows.append(rows[t.id])
+        size += t.size
+        length += t.tracklen
+    playlists.append((pl.id, str(pl.name), pl.is_spl, plrows.tostring(), (len(plrows), size, length)))
+  st = os.stat(source)
+  data = {
+    "version": (Snapshot.version, array.array("l").itemsize),
+    "id": itdb.id,
+    "source": (st.st_size, st.st_mtime, fileDigest(copy or source)),
+    "count": len(tracks),
+    "strings": "\0".join(strings),
+    "cols": cols,
+    "playlists": playlists,
+  }
+  sf = open(snapFile + ".new", "wb")
+  cPickle.dump(data, sf, 2)
+  sf.close()
+  os.rename(snapFile + ".new", snapFile)
+
+# The Snapshot in snapFile if source still has the contents it was
+# taken from (same size and mtime, or else same SHA1), else None
+def readSnapshot(snapFile, source):
+  try:
+    sf = open(snapFile, "rb")
+    data = cPickle.load(sf)
+    sf.close()
+    st = os.stat(source)
+  except Exception:
+    return None
+  if data.get("version") != (Snapshot.version, array.array("l").itemsize):
+    return None
+  size, mtime, digest = data["source"]
+  if st.st_size != size:
+    return None
+  if st.st_mtime != mtime and fileDigest(source) != digest:
+    return None
+  Msg("DEBUG: Using snapshot %s" % snapFile, 2)
+  return Snapshot(data)
+
+# An ItdbFile for file, or None if it can't be read that way
+def readItdbFile(file):
+  try:
+    itdb = ItdbFile(file)
+  except (EnvironmentError, ValueError, struct.error, mmap.error), e:
+    Msg("DEBUG: Can't read %s directly (%s)" % (file, e), 2)
+    return None
+  Msg("DEBUG: Reading %s directly" % file, 2)
+  return itdb
+
+# Like openItdb(), but for read-only commands: uses up to date
+# snapshots in place of the itdbs where there are some, else reads the
+# itdb files directly, and only falls back to libgpod if that fails.
+# Under 'serve' the resident itdbs are used instead.
+def openReadOnly(which):
+  global i_itdb
+  global l_itdb
+  global ipodDbname
+  if serving:
+    openItdb(which)
+    return
+  start = time.time()
+  ipodDbname = os.path.join(options.mountpoint,"iPod_Control/iTunes/iTunesDB")
+  if which == "db" or which == "both":
+    l_itdb = readSnapshot(localSnapFile(), options.dbname)
+    if not l_itdb and os.path.isfile(options.dbname):
+      l_itdb = readItdbFile(options.dbname)
+      if l_itdb: # Paths of gtkpod's local tracks are in the ext info
+        extStore.load()
+        for t in l_itdb.tracks:
+          if not t.ipod_path and extInfo.get(t.id, {}).has_key("filename_locale"):
+            t.ipod_path = extInfo[t.id]["filename_locale"]
+    if not l_itdb:
+      openItdb("db")
+  if which == "ipod" or which == "both":
+    i_itdb = None
+    if not os.path.exists(ipodDbFiles()[1]): # Unmerged play counts
+      i_itdb = readSnapshot(ipodSnapFile(), ipodDbname)
+      if not i_itdb:
+        i_itdb = readItdbFile(ipodDbname)
+    if not i_itdb:
+      openItdb("ipod")
+  if which == "both":
+    readMap()
+  timing("open snapshot %s" % which, start)
+
+# Table of an itdb's tracks for searching, built once per run. Fields
+# are converted with str() up front and all patterns are matched in one
+# pass over them; path prefixes are looked up in a sorted path list.
+class TrackIndex:
+    def __init__(self, itdb):
+        self.tracks = []
+        self.fields = [] # (title, artist, album)
+        paths = []
+        for track in itdbTracks(itdb):
+            f = (str(track.title), str(track.artist), str(track.album))
+            self.tracks.append(track)
+            self.fields.append(f)
+            if track.ipod_path:
+                paths.append((str(track.ipod_path), len(self.tracks) - 1))
+        paths.sort()
+        self.paths = [p for p, row in paths]
+        self.pathrows = [row for p, row in paths]
+
+    # Rows whose fields selected by flags match any of the regexes
+    def search(self, patterns, flags):
+        p = re.compile("|".join(["(?:%s)" % x for x in patterns]), re.IGNORECASE)
+        fields = [i for i in range(3) if flags & (1 << i)]
+        ret = []
+        for row in xrange(len(self.fields)):
+            for i in fields:
+                if p.search(self.fields[row][i]):
+                    ret.append(row)
+                    break
+        return ret
+
+    # Rows of tracks whose path starts with prefix
+    def under(self, prefix):
+        ret = []
+        i = bisect.bisect_left(self.paths, prefix)
+        while i < len(self.paths) and self.paths[i].startswith(prefix):
+            ret.append(self.pathrows[i])
+            i += 1
+        return ret
+
+trackIndexes = {}
+
+# Returns the TrackIndex for itdb, rebuilt if tracks were added/removed
+def trackIndex(itdb):
+  key = id(itdb)
+  if isinstance(itdb, ReadOnlyItdb):
+    n = len(itdb.tracks)
+  else:
+    n = gpod.itdb_tracks_number(itdb)
+  if not trackIndexes.has_key(key) or len(trackIndexes[key].tracks) != n:
+    trackIndexes[key] = TrackIndex(itdb)
+  return trackIndexes[key]
+
+# Find tracks that match given patterns (a list, or a single pattern)
+# in one pass. Patterns are one of:
 #  <regex>: Regex pattern (if <flags> is set)
 #   <file>: List of files to find
 #    <dir>: Tracks under <dir>
@@ -442,31 +1392,23 @@ def argLen(arg, n):
 #   0x1: regex search title
 #   0x2: regex search artist
 #   0x4: regex search album
-def tracksMatch(itdb, pattern, flags):
-  retAry = []
+def tracksMatch(itdb, patterns, flags):
+  if isinstance(patterns, str):
+    patterns = [patterns]
+  if not patterns:
+    return []
+  start = time.time()
+  index = trackIndex(itdb)
   if flags: # Find by regex
-    Msg("DEBUG: Finding with regex: %s" % pattern, 2)
-    p=re.compile(pattern, re.IGNORECASE)
-    for track in gpod.sw_get_tracks(itdb):
-      if flags & 0x1:
-        if p.search(str(track.title)):
-          retAry.append(track)
-          continue
-      if flags & 0x2:
-        if p.search(str(track.artist)):
-          retAry.append(track)
-          continue
-      if flags & 0x4:
-        if p.search(str(track.album)):
-          retAry.append(track)
-          continue
+    Msg("DEBUG: Finding with regex: %s" % patterns, 2)
+    rows = index.search(patterns, flags)
   else: # Find dirs/files that match
-    pattern = os.path.abspath(pattern)
-    for track in gpod.sw_get_tracks(itdb):
-      if track.ipod_path:
-        if track.ipod_path.find(pattern) == 0:
-          retAry.append(track)
-  return retAry
+    rows = set()
+    for pattern in patterns:
+      rows.update(index.under(os.path.abspath(pattern)))
+    rows = sorted(rows)
+  timing("match %d patterns" % len(patterns), start)
+  return [index.tracks[row] for row in rows]
 
 # Create and return a new itdb populated with an empty
 # master playlist and an empty Podcast playlist
@@ -482,14 +1424,62 @@ def makeItdb():
     sys.exit(1)
   Msg("INFO: Creating new itdb.", 1)
   mpl = gpod.itdb_playlist_new("Library", 0)
-  gpod.itdb_playlist_add(itdb, mpl, -1)
+  playlistAdd(itdb, mpl, -1)
   gpod.itdb_playlist_set_mpl(mpl)
   ppl = gpod.itdb_playlist_new("Podcasts", 0)
-  gpod.itdb_playlist_add(itdb, ppl, -1)
+  playlistAdd(itdb, ppl, -1)
   gpod.itdb_playlist_set_podcasts(ppl)
   newItdb = True
   return itdb
 
+# itdbs kept parsed between commands by 'serve': "db"/"ipod" ->
+# (files, their stamps, itdb). Only filled while serving.
+resident = {}
+serving = False
+
+# Files the local itdb is read from, ext info included
+def localDbFiles():
+  ext = options.dbname + ".ext"
+  return (options.dbname, ext, ext + ".idx", ext + ".journal")
+
+# Files the iPod itdb is read from, play counts included
+def ipodDbFiles():
+  itunes = os.path.join(options.mountpoint, "iPod_Control", "iTunes")
+  return (os.path.join(itunes, "iTunesDB"), os.path.join(itunes, "Play Counts"))
+
+def fileStamps(files):
+  stamps = []
+  for file in files:
+    try:
+      st = os.stat(file)
+      stamps.append((st.st_size, st.st_mtime))
+    except OSError:
+      stamps.append(None)
+  return stamps
+
+# The resident itdb for which, if it was read from files which haven't
+# changed since. Else drops it and returns None.
+def residentItdb(which, files):
+  if not resident.has_key(which):
+    return None
+  kept, stamps, itdb = resident[which]
+  if kept == files and stamps == fileStamps(files):
+    return itdb
+  dropItdb(which)
+  return None
+
+def keepItdb(which, files, itdb):
+  if serving and not resident.has_key(which):
+    resident[which] = (files, fileStamps(files), itdb)
+
+def dropItdb(which):
+  if not resident.has_key(which):
+    return
+  itdb = resident.pop(which)[2]
+  trackIndexes.pop(id(itdb), None)
+  playlistRegistries.pop(id(itdb), None)
+  gpod.itdb_free(itdb)
+
 # Opens the ITDB, either "local", "ipod" or "both"
 # Exits if fail, or returns nothing (sets globals)
 def openItdb(which):
@@ -497,10 +1487,14 @@ def openItdb(which):
   global l_itdb
   global ipodDbname
   global dotitdb
+  start = time.time()
   ipodDbname = os.path.join(options.mountpoint,"iPod_Control/iTunes/iTunesDB")
   Msg("DEBUG: Opening itdb %s.." % which, 2)
   if which == "db" or which == "both":
-    if not os.path.isfile(options.dbname):
+    l_itdb = residentItdb("db", localDbFiles())
+    if l_itdb:
+      Msg("DEBUG: Using resident local itdb", 2)
+    elif not os.path.isfile(options.dbname):
       l_itdb = makeItdb()
     else:
       l_itdb = gpod.itdb_parse_file(options.dbname, None)
@@ -509,8 +1503,13 @@ def openItdb(which):
     if not l_itdb:
       Msg("ERROR: Failed to read local itdb!", 0)
       sys.exit(1)
+    keepItdb("db", localDbFiles(), l_itdb)
   if which == "ipod" or which == "both":
-    i_itdb = gpod.itdb_parse(options.mountpoint, None)
+    i_itdb = residentItdb("ipod", ipodDbFiles())
+    if i_itdb:
+      Msg("DEBUG: Using resident iPod itdb", 2)
+    else:
+      i_itdb = gpod.itdb_parse(options.mountpoint, None)
     if not os.path.isdir(options.mountpoint):
       Msg("ERROR: Can't find ipod mountpoint %s" % options.mountpoint, 0)
       Msg("ERROR: Specify mountpoint with -m or set mountpoint near the top of script", 0)
@@ -518,9 +1517,11 @@ def openItdb(which):
     if not i_itdb:
       Msg("ERROR: Failed to read iPod itdb!", 0)
       sys.exit(1)
+    keepItdb("ipod", ipodDbFiles(), i_itdb)
   if which == "both":
     readMap() # Read ipod -> local track map db
   Msg("DEBUG: Opened itdb %s" % which, 2)
+  timing("open itdb %s" % which, start)
 
 # Write ITDB to disk, either "ipod" or "db"
 # Returns status of itdb_write call
@@ -534,20 +1535,73 @@ def writeItdb(which):
   if which == "db" or which == "both":
     gpod.itdb_write_file(l_itdb, options.dbname, None)
     writeExt(False)
+    writeSnapshot(l_itdb, localSnapFile(), options.dbname)
+
+# Playlists of an itdb indexed by id and by name. Built on first
+# lookup, then kept current by playlistAdd() and playlistRemove(),
+# which must be used instead of itdb_playlist_add/remove.
+class PlaylistRegistry:
+    def __init__(self, itdb):
+        self.byId = {}
+        self.byName = {} # name -> playlists, first one wins
+        for pl in itdbPlaylists(itdb):
+            self.add(pl)
+
+    def add(self, pl):
+        self.byId[pl.id] = pl
+        self.byName.setdefault(pl.name, []).append(pl)
+
+    def remove(self, pl):
+        self.byId.pop(pl.id, None)
+        same = [p for p in self.byName.get(pl.name, []) if p.id != pl.id]
+        if same:
+            self.byName[pl.name] = same
+        else:
+            self.byName.pop(pl.name, None)
+
+playlistRegistries = {}
+
+def playlists(itdb):
+  key = id(itdb)
+  if not playlistRegistries.has_key(key):
+    playlistRegistries[key] = PlaylistRegistry(itdb)
+  return playlistRegistries[key]
+
+def playlistAdd(itdb, pl, pos):
+  gpod.itdb_playlist_add(itdb, pl, pos) # Assigns pl.id if needed
+  if playlistRegistries.has_key(id(itdb)):
+    playlists(itdb).add(pl)
+
+def playlistRemove(itdb, pl):
+  playlists(itdb).remove(pl)
+  gpod.itdb_playlist_remove(pl)
 
 # itdb_playlist_by_id is broken, need to do it here
 def playlistById(itdb, id):
-  for p in gpod.sw_get_playlists(itdb):
-    if p.id == id:
-      return p
-  return NULL
+  return playlists(itdb).byId.get(id)
 
 # itdb_playlist_by_name is broken, need to do it here
 def playlistByName(itdb, name):
-  for p in gpod.sw_get_playlists(itdb):
-    if p.name == name:
-      return p
-  return NULL
+  pls = playlists(itdb).byName.get(name)
+  if pls:
+    return pls[0]
+  return None
+
+# Statistics for each playlist in itdb as {id: (tracks, bytes, msecs)},
+# computed in one pass over each playlist's tracks. Snapshots and
+# ItdbFiles have them already.
+def playlistStats(itdb):
+  if isinstance(itdb, ReadOnlyItdb):
+    return itdb.playlistStats()
+  stats = {}
+  for pl in gpod.sw_get_playlists(itdb):
+    count = size = length = 0
+    for track in gpod.sw_get_playlist_tracks(pl):
+      count += 1
+      size += track.size
+      length += track.tracklen
+    stats[pl.id] = (count, size, length)
+  return stats
 
 def showSPL(pl):
   print "Playlist: %s (0x%x)" % (pl.name, pl.id)
@@ -737,49 +1791,450 @@ def checkSPLs(itdb):
       for i in xrange(gpod.sw_get_list_len(p.splrules.rules)):
         rule = gpod.sw_get_rule(p.splrules.rules, i)
         if rule.field == 0x28:
-          rpl = playlistById(itdb, rule.fromvalue) # ** itdb_playlist_by_id broken
+          rpl = playlistById(itdb, rule.fromvalue)
           if not rpl:
             Msg("WARN: Rule in playlist '%s' (0x%x) matches unknown playlist 0x%x" % (p.name, p.id, rule.fromvalue), 0)
             ret = False
           else:
             Msg("DEBUG: Rule in SPL '%s' refers to playlist '%s'" % (p.name, rpl.name), 2)
+  deps = splDeps(itdb)
+  for cycle in splOrder(deps)[1]:
+    names = " -> ".join(["'%s'" % deps[id][0].name for id in cycle])
+    Msg("WARN: Smart playlists refer to each other in a loop: %s" % names, 0)
+    ret = False
   return ret
 
 
-# Match ipod files with local DB
+# Raised for smart playlist rules the native evaluator can't handle
+class SplUnsupported(Exception):
+  pass
+
+# Columnar table of an itdb's tracks for evaluating smart playlists
+# natively. Each rule field becomes a numpy array in track list order,
+# built on first use, and each rule a boolean mask over it.
+class SplTable:
+    strings = {0x02: "title", 0x03: "album", 0x04: "artist", 0x08: "genre",
+               0x09: "filetype", 0x0e: "comment", 0x12: "composer",
+               0x27: "grouping"}
+    ints = {0x05: "bitrate", 0x06: "samplerate", 0x07: "year",
+            0x0a: "time_modified", 0x0b: "track_nr", 0x0c: "size",
+            0x0d: "tracklen", 0x10: "time_added", 0x16: "playcount",
+            0x17: "time_played", 0x18: "cd_nr", 0x19: "rating",
+            0x1f: "compilation", 0x23: "BPM"}
+    # limitsort -> (field, ascending unless 0x80000000 is set)
+    sorts = {0x03: (0x02, True), 0x04: (0x03, True), 0x05: (0x04, True),
+             0x07: (0x08, True), 0x10: (0x10, False), 0x14: (0x16, False),
+             0x15: (0x17, False), 0x17: (0x19, False)}
+
+    def __init__(self, itdb):
+        self.itdb = itdb
+        self.tracks = list(gpod.sw_get_tracks(itdb))
+        self.rows = dict([(t.id, i) for i, t in enumerate(self.tracks)])
+        self.cols = {}
+        self.done = set() # Playlists evaluated this pass
+        self.busy = set() # Playlists being evaluated, to catch cycles
+        self.mismatches = 0
+
+    def column(self, field):
+        if not self.cols.has_key(field):
+            if field in self.strings:
+                name = self.strings[field]
+                col = numpy.array([str(getattr(t, name) or "") for t in self.tracks] or [""])
+            elif field in self.ints:
+                name = self.ints[field]
+                col = numpy.array([int(getattr(t, name) or 0) for t in self.tracks] or [0], dtype=numpy.int64)
+                if field == 0x0d: # Rules are in seconds
+                    col = col / 1000
+            elif field == "checked":
+                col = numpy.array([t.checked for t in self.tracks] or [0])
+            else:
+                raise SplUnsupported("field 0x%x" % field)
+            self.cols[field] = col[:len(self.tracks)]
+        return self.cols[field]
+
+    # Mask of the tracks in playlist id, evaluating it first if it's
+    # smart. Only for the given rows, unless rows is None.
+    def members(self, id, rows):
+        pl = playlistById(self.itdb, id)
+        if not pl:
+            raise SplUnsupported("unknown playlist 0x%x" % id)
+        if pl.is_spl:
+            self.update(pl)
+        mask = numpy.zeros(len(self.tracks), dtype=bool)
+        for t in gpod.sw_get_playlist_tracks(pl):
+            if self.rows.has_key(t.id):
+                mask[self.rows[t.id]] = True
+        if rows is not None:
+            return mask[rows]
+        return mask
+
+    def values(self, field, rows):
+        if rows is None:
+            return self.column(field)
+        return self.column(field)[rows]
+
+    # Mask of rows (all if None) matching rule r
+    def rule(self, r, rows):
+        action = r.action & 0x00ffffff
+        negate = r.action & 0x02000000
+        if r.field == 0x28:
+            if action != 0x1:
+                raise SplUnsupported("playlist action 0x%x" % r.action)
+            mask = self.members(r.fromvalue, rows)
+        elif r.field in self.strings:
+            col = self.values(r.field, rows)
+            value = str(r.string or "")
+            if action == 0x1:
+                mask = col == value
+            elif action == 0x2:
+                mask = numpy.char.find(col, value) >= 0
+            elif action == 0x4:
+                mask = numpy.char.startswith(col, value)
+            elif action == 0x8:
+                mask = numpy.char.endswith(col, value)
+            else:
+                raise SplUnsupported("string action 0x%x" % r.action)
+        elif r.field in self.ints:
+            col = self.values(r.field, rows)
+            if action == 0x1:
+                mask = col == r.fromvalue
+            elif action == 0x10:
+                mask = col > r.fromvalue
+            elif action == 0x40:
+                mask = col < r.fromvalue
+            elif action == 0x100:
+                lo, hi = sorted((r.fromvalue, r.tovalue))
+                mask = (col >= lo) & (col <= hi)
+            elif action == 0x200 and r.field in (0x0a, 0x10, 0x17):
+                now = int(time.time()) # Track times are time_t in libgpod
+                mask = col > now + r.fromdate * r.fromunits
+            else:
+                raise SplUnsupported("int action 0x%x" % r.action)
+        else:
+            raise SplUnsupported("field 0x%x" % r.field)
+        if negate:
+            mask = ~mask
+        return mask
+
+    # Keep rows in limitsort order while they fit in the limit, like
+    # libgpod: a row that doesn't fit is skipped and later ones still
+    # tried until the limit is reached
+    def limit(self, pl, rows):
+        pref = pl.splpref
+        sort = pref.limitsort & 0x7fffffff
+        if not self.sorts.has_key(sort):
+            raise SplUnsupported("limit sort 0x%x" % pref.limitsort)
+        field, ascending = self.sorts[sort]
+        if pref.limitsort & 0x80000000:
+            ascending = not ascending
+        col = self.column(field)[rows]
+        if not ascending and field in self.ints:
+            col = -col
+        order = numpy.argsort(col, kind="mergesort")
+        if not ascending and not field in self.ints:
+            order = order[::-1]
+        rows = rows[order]
+        if pref.limittype in (0x01, 0x04): # Track lengths in msecs
+            msecs = numpy.array([self.tracks[row].tracklen for row in rows], dtype=numpy.float64)
+        if pref.limittype == 0x01: # minutes
+            values = msecs / 60000.0
+        elif pref.limittype == 0x02: # Mb
+            values = self.column(0x0c)[rows] / 1048576.0
+        elif pref.limittype == 0x03: # songs
+            values = numpy.ones(len(rows))
+        elif pref.limittype == 0x04: # hours
+            values = msecs / 3600000.0
+        elif pref.limittype == 0x05: # Gb
+            values = self.column(0x0c)[rows] / 1073741824.0
+        else:
+            raise SplUnsupported("limit type 0x%x" % pref.limittype)
+        keep = []
+        total = 0.0
+        for row, value in zip(rows, values):
+            if total >= pref.limitvalue:
+                break
+            if total + value <= pref.limitvalue:
+                total += value
+                keep.append(row)
+        return numpy.array(keep, dtype=rows.dtype)
+
+    # Mask of rows (all if None) matching pl's rules, ignoring limits
+    def matches(self, pl, rows):
+        rules = splRules(pl)
+        if rows is None:
+            mask = numpy.ones(len(self.tracks), dtype=bool)
+        else:
+            mask = numpy.ones(len(rows), dtype=bool)
+        if pl.splpref.checkrules and rules:
+            masks = [self.rule(r, rows) for r in rules]
+            if pl.splrules.match_operator == 1: # Any
+                mask = numpy.logical_or.reduce(masks)
+            else:
+                mask = numpy.logical_and.reduce(masks)
+        if pl.splpref.matchcheckedonly:
+            mask &= self.values("checked", rows) == 0
+        return mask
+
+    # Row numbers of the tracks pl should hold, in order
+    def evaluate(self, pl):
+        rows = numpy.flatnonzero(self.matches(pl, None))
+        if pl.splpref.checklimits:
+            rows = self.limit(pl, rows)
+        return rows
+
+    # Re-evaluate pl for the given rows only. Only valid for playlists
+    # without limits, whose other rows can't have changed.
+    def updateRows(self, pl, rows):
+        if options.spl == "check":
+            self.update(pl)
+            return
+        self.done.add(pl.id)
+        rows = numpy.array(sorted(rows), dtype=int)
+        try:
+            mask = self.matches(pl, rows)
+        except SplUnsupported, e:
+            Msg("DEBUG: Evaluating '%s' with libgpod (%s)" % (pl.name, e), 2)
+            gpod.itdb_spl_update(pl)
+            return
+        have = set([t.id for t in gpod.sw_get_playlist_tracks(pl)])
+        for row, hit in zip(rows, mask):
+            t = self.tracks[row]
+            if hit and not t.id in have:
+                gpod.itdb_playlist_add_track(pl, t, -1)
+            elif not hit and t.id in have:
+                gpod.itdb_playlist_remove_track(pl, t)
+
+    def update(self, pl):
+        if pl.id in self.done:
+            return
+        if pl.id in self.busy:
+            raise SplUnsupported("playlist '%s' refers to itself" % pl.name)
+        self.busy.add(pl.id)
+        try:
+            try:
+                rows = self.evaluate(pl)
+            except SplUnsupported, e:
+                Msg("DEBUG: Evaluating '%s' with libgpod (%s)" % (pl.name, e), 2)
+                gpod.itdb_spl_update(pl)
+                return
+        finally:
+            self.busy.discard(pl.id)
+            self.done.add(pl.id)
+        want = [self.tracks[i] for i in rows]
+        if options.spl == "check":
+            gpod.itdb_spl_update(pl)
+            got = set([t.id for t in gpod.sw_get_playlist_tracks(pl)])
+            mine = set([t.id for t in want])
+            if got != mine:
+                Msg("WARN: Playlist '%s': native %d tracks, libgpod %d (%d only native, %d only libgpod)" % (pl.name, len(mine), len(got), len(mine - got), len(got - mine)), 0)
+                self.mismatches += 1
+            return
+        self.apply(pl, want)
+
+    # Set the tracks of pl to want, touching as few entries as possible
+    def apply(self, pl, want):
+        have = gpod.sw_get_playlist_tracks(pl)
+        if [t.id for t in have] == [t.id for t in want]:
+            return
+        if pl.splpref.checklimits: # Order matters, rebuild it
+            for t in have:
+                gpod.itdb_playlist_remove_track(pl, t)
+            keep = set()
+        else:
+            wanted = set([t.id for t in want])
+            keep = set()
+            for t in have:
+                if t.id in wanted:
+                    keep.add(t.id)
+                else:
+                    gpod.itdb_playlist_remove_track(pl, t)
+        for t in want:
+            if not t.id in keep:
+                gpod.itdb_playlist_add_track(pl, t, -1)
+
+# Evaluate all smart playlists in itdb. Done natively with numpy where
+# it's installed and the rules are understood, otherwise by libgpod.
+# With --spl=check both are run, libgpod's results kept and any
+# differences reported. Returns the number of playlists that differed.
+def splUpdateAll(itdb):
+  if not numpy or options.spl == "gpod":
+    gpod.itdb_spl_update_all(itdb)
+    return 0
+  table = SplTable(itdb)
+  for pl in gpod.sw_get_playlists(itdb):
+    if pl.is_spl:
+      table.update(pl)
+  if table.mismatches:
+    Msg("WARN: %d smart playlists evaluated differently by libgpod" % table.mismatches, 0)
+  return table.mismatches
+
+# Rules of smart playlist pl
+def splRules(pl):
+  n = gpod.sw_get_list_len(pl.splrules.rules)
+  return [gpod.sw_get_rule(pl.splrules.rules, i) for i in xrange(n)]
+
+# Smart playlist dependencies in itdb: playlist id -> (playlist, fields,
+# refs). fields holds the rule field codes the playlist's contents
+# depend on, plus "time" if they change with time (rules like 'in the
+# last', random limits) and "checked" for match checked only. refs are
+# the ids of playlists its rules refer to.
+def splDeps(itdb):
+  deps = {}
+  for pl in gpod.sw_get_playlists(itdb):
+    if not pl.is_spl:
+      continue
+    fields = set()
+    refs = set()
+    for rule in splRules(pl):
+      if rule.field == 0x28:
+        refs.add(rule.fromvalue)
+      else:
+        fields.add(rule.field)
+      if rule.action & 0x200:
+        fields.add("time")
+    if pl.splpref.matchcheckedonly:
+      fields.add("checked")
+    if pl.splpref.checklimits:
+      sort = SplTable.sorts.get(pl.splpref.limitsort & 0x7fffffff)
+      if sort:
+        fields.add(sort[0])
+      else:
+        fields.add("time")
+      fields.update([0x0c, 0x0d])
+    deps[pl.id] = (pl, fields, refs)
+  return deps
+
+# Orders the playlists in deps so each comes after the smart playlists
+# it refers to. Returns (order, cycles), each cycle a list of ids.
+def splOrder(deps):
+  order = []
+  cycles = []
+  state = {} # id -> 1 while visiting, 2 when done
+  for id in deps.keys():
+    splVisit(deps, id, state, [], order, cycles)
+  return order, cycles
+
+def splVisit(deps, id, state, path, order, cycles):
+  if state.get(id) == 2 or not deps.has_key(id):
+    return
+  if state.get(id) == 1:
+    cycles.append(path[path.index(id):] + [id])
+    return
+  state[id] = 1
+  for ref in deps[id][2]:
+    splVisit(deps, ref, state, path + [id], order, cycles)
+  state[id] = 2
+  order.append(id)
+
+# Re-evaluate the smart playlists in itdb affected by a change to the
+# fields (rule field codes, None for all) of the tracks with ids tids.
+# Playlists are visited in dependency order. Those without limits or
+# time based rules are only re-evaluated for the changed tracks.
+# Returns the number that differed with --spl=check, like splUpdateAll().
+def splUpdate(itdb, tids, fields):
+  deps = splDeps(itdb)
+  order, cycles = splOrder(deps)
+  tids = set(tids)
+  dirty = set()
+  for id in order:
+    pl, f, refs = deps[id]
+    if "time" in f or refs & dirty or (tids and (fields is None or f & fields)):
+      dirty.add(id)
+  Msg("DEBUG: %d of %d smart playlists affected by %d changed tracks" % (len(dirty), len(order), len(tids)), 2)
+  if not dirty:
+    return 0
+  if not numpy or options.spl == "gpod":
+    for id in order:
+      if id in dirty:
+        gpod.itdb_spl_update(deps[id][0])
+    return 0
+  table = SplTable(itdb)
+  table.done = set(deps.keys()) - dirty
+  rows = [table.rows[t] for t in tids if table.rows.has_key(t)]
+  full = set() # Playlists whose contents may have changed on any row
+  for id in order:
+    if not id in dirty:
+      continue
+    pl, f, refs = deps[id]
+    if pl.splpref.checklimits or "time" in f or refs & full or cycles:
+      table.update(pl)
+      full.add(id)
+    else:
+      table.updateRows(pl, rows)
+  if table.mismatches:
+    Msg("WARN: %d smart playlists evaluated differently by libgpod" % table.mismatches, 0)
+  return table.mismatches
+
+# Normalized (title, artist, album) of a track, for joining on tags
+def tagKey(t):
+  return tuple([" ".join(str(f or "").lower().split()) for f in (t.title, t.artist, t.album)])
+
+# Match ipod files with local DB. iPod tracks are hash joined to local
+# ones on their normalized tags. Where that finds no single track of
+# about the right size, fall back to comparing fileHash fingerprints
+# against local files of exactly the same size.
 def Command_Makemap():
   matches = 0
   ntracks = 0
+  bytags = 0
+  bycontent = 0
   openItdb("both")
   readMap()
   s = Spinner()
-  titles = {}
-  artists = {}
-  albums = {}
-  tracks = {}
+  tracks = {} # tag key -> local tracks
   for ltrack in gpod.sw_get_tracks(l_itdb):
-    titles[ltrack.title] = ltrack.id
-    artists[ltrack.artist] = ltrack.id
-    albums[ltrack.album] = ltrack.id
-    tracks[ltrack.id] = [ltrack.title, ltrack.artist, ltrack.album]
-  trackTree = gpod.itdb_track_id_tree_create(l_itdb) # Speedup
+    tracks.setdefault(tagKey(ltrack), []).append(ltrack)
+  sizes = None # file size -> local tracks, only built if needed
   for itrack in gpod.sw_get_tracks(i_itdb):
     ntracks += 1
     s.Print()
-    for lid in tracks.keys():
-      if tracks[lid] == [itrack.title,itrack.artist,itrack.album]:
-        isize = fileSize(gpod.itdb_filename_on_ipod(itrack))
-        ltrack = gpod.itdb_track_id_tree_by_id(trackTree, lid)
-        lsize = fileSize(str(ltrack.ipod_path))
-        if lsize != 0 and abs(lsize-isize)/lsize < 0.01:
-          setMap(ltrack, itrack)
-          matches += 1
-        else:
-          Msg("Filesize mismatch for %s (%d/%d), ignoring. (%s, %s)" % (itrack.title, isize, lsize, itrack.ipod_path, ltrack.ipod_path), 1)
+    ifile = gpod.itdb_filename_on_ipod(itrack)
+    isize = fileSize(ifile)
+    found = []
+    for ltrack in tracks.get(tagKey(itrack), []):
+      lsize = fileSize(str(ltrack.ipod_path))
+      if lsize != 0 and abs(lsize-isize)/float(lsize) < 0.01:
+        found.append(ltrack)
+      else:
+        Msg("Filesize mismatch for %s (%d/%d), ignoring. (%s, %s)" % (itrack.title, isize, lsize, itrack.ipod_path, ltrack.ipod_path), 1)
+    if len(found) == 1:
+      setMap(found[0], itrack)
+      bytags += 1
+      continue
+    if not isize: # No file to fingerprint
+      continue
+    if sizes is None:
+      Msg("DEBUG: Indexing local file sizes", 2)
+      sizes = {}
+      for ltrack in gpod.sw_get_tracks(l_itdb):
+        sizes.setdefault(fileSize(str(ltrack.ipod_path)), []).append(ltrack)
+    candidates = sizes.get(isize, [])
+    if not candidates:
+      if found:
+        Msg("WARN: %s (%s) matches %d local tracks, ignoring" % (itrack.title, itrack.artist, len(found)), 1)
+      continue
+    hashCache.prefetch([str(t.ipod_path) for t in candidates])
+    ihash = fileHash(ifile)
+    same = []
+    for ltrack in candidates:
+      if hashCache.get(str(ltrack.ipod_path)) == ihash:
+        same.append(ltrack)
+    if not same:
+      if found:
+        Msg("WARN: %s (%s) matches %d local tracks, ignoring" % (itrack.title, itrack.artist, len(found)), 1)
+      continue
+    for ltrack in same: # Prefer a content match that also matched on tags
+      if ltrack.id in [t.id for t in found]:
+        break
+    else:
+      ltrack = same[0]
+    setMap(ltrack, itrack)
+    bycontent += 1
   s.Done()
-  gpod.itdb_track_id_tree_destroy(trackTree)
   writeMap()
-  Msg("Matched %d out of %d tracks on iPod" % (matches, ntracks), 1)
+  hashCache.save()
+  matches = bytags + bycontent
+  Msg("Matched %d out of %d tracks on iPod (%d by tags, %d by content)" % (matches, ntracks, bytags, bycontent), 1)
   sys.exit(0)
 
 # Handles adding new tracks to the DB
@@ -805,33 +2260,34 @@ def Command_Add (arg):
       sys.exit(1)
   else: isPodcast = False
   Msg("INFO: Adding files: %s" % arg[1:], 2)
+  start = time.time()
   files = validFiles(arg[1:])
+  start = phaseDone("Scanned directories", start, len(files))
   mpl = gpod.itdb_playlist_mpl(itdb)
   added = 0
   tracksAdded = []
+  # Path index of tracks already in the db, built once per run
+  paths = set()
+  for tr in gpod.sw_get_tracks(itdb):
+    if tr.ipod_path:
+      paths.add(str(tr.ipod_path))
+  start = phaseDone("Indexed database", start, len(paths))
   for file in files:
-    skip = 0 # Make sure it's not already in the db
-    for tr in gpod.sw_get_tracks(itdb):
-      if tr.ipod_path == file:
-        Msg("WARN: File already in db: %s" % file, 1)
-        skip = 1
-        break
-    if skip:
+    if file in paths: # Make sure it's not already in the db
+      Msg("WARN: File already in db: %s" % file, 1)
       continue
-    if eyed3.mp3.isMp3File(file): # Open, make sure it's an mp3
-      audioFile = eyed3.mp3.Mp3AudioFile(file, eyed3.id3.ID3_ANY_VERSION)
-      tag = audioFile.tag
-    else:
+    tag = tagCache.get(file)
+    if not tag or not tag['mp3']: # Make sure it's an mp3
       Msg("WARN: %s not an mp3, skipping." % file, 2)
       continue
-    if not tag:
+    if not tag['tagged']:
       Msg("WARN: No ID3 tags for %s, skipping" % file, 1)
       continue
 
     filesize = fileSize(file)
     if isiPod:
       if ipodFree - filesize < 5000000: # Leave 5Mb free
-        Msg("WARN: Not enough free space for %s, skipping" % track.file, 1)
+        Msg("WARN: Not enough free space for %s, skipping" % file, 1)
         continue
       else:
         ipodFree -= filesize
@@ -840,24 +2296,18 @@ def Command_Add (arg):
     track.filetype = "mp3"
     track.ipod_path = file
     track.size = filesize
-    # br = audioFile.bit_rate_str() #broken
-    # br[0] is true if vbr
-    track.bitrate = 128
-    #track.tracklen = audioFile.getPlayTime() * 1000 #broken
-    track.tracklen = 300000
-    track.album = str(tag.album)
-    track.artist = str(tag.artist)
-    track.title = str(tag.title)
-    track.genre = str(tag.genre)
+    track.bitrate = tag['bitrate']
+    track.tracklen = tag['tracklen']
+    track.album = tag['album']
+    track.artist = tag['artist']
+    track.title = tag['title']
+    track.genre = tag['genre']
     now = int(time.time()) + 2082844800
     track.time_added = now
     track.rating = int(options.rating) * 20
     if track.title == "":
       Msg("WARN: %s has no id3 title, skipping." % file, 1)
       continue
-  # Add it and print result
-    gpod.itdb_track_add(itdb, track, -1)
-    gpod.itdb_playlist_add_track(mpl, track, -1)
     if isPodcast:
       track.flag1 = 0x02
       track.flag2 = 0x01
@@ -866,7 +2316,20 @@ def Command_Add (arg):
       track.mark_unplayed = 0x02
       if not len (track.album): # Podcasts must have a valid album
         track.album = track.title
+    paths.add(file)
+    tracksAdded.append((file, track))
+  tagCache.save()
+  start = phaseDone("Read tags", start, len(files))
+
+  # Add them all in one go and print result
+  for file, track in tracksAdded:
+    gpod.itdb_track_add(itdb, track, -1)
+    gpod.itdb_playlist_add_track(mpl, track, -1)
+    if isPodcast:
       gpod.itdb_playlist_add_track(podcasts, track, -1)
+  splUpdate(itdb, [track.id for file, track in tracksAdded], None)
+  start = phaseDone("Inserted tracks", start, len(tracksAdded))
+  for file, track in tracksAdded:
     if isiPod:
       track.transferred = False
       track.ipod_path = None
@@ -875,13 +2338,14 @@ def Command_Add (arg):
         thumb = thumbfile(file)
         if thumb:
           gpod.itdb_track_set_thumbnails(track, thumb)
-    tracksAdded.append(track)
     Msg( "INFO: Added file: %s" % file, 1)
     Msg( "          Artist: %s" % track.artist, 2)
     Msg( "           Album: %s" % track.album, 2)
     Msg( "           Title: %s" % track.title, 2)
     Msg( "          Rating: %s" % stars(track), 2)
     added += 1
+  if isiPod:
+    start = phaseDone("Copied to iPod", start, added)
 
   if added:
     if isiPod:
@@ -891,14 +2355,7 @@ def Command_Add (arg):
     Msg("INFO: %d tracks added." % added, 1)
   else:
     Msg("INFO: Nothing added, not writing ITDB", 1)
-  if tmpDir:
-    for file in os.listdir(tmpDir):
-      fl = os.path.join(tmpDir, file)
-      os.unlink(fl)
-    try:
-      os.rmdir(tmpDir)
-    except:
-      0
+  artCache.trim()
   if newItdb:
     Msg("WARN: *** A new local database has been created. *** ", 1)
     Msg("WARN: *** For iPod smart playlist sync, you MUST add playlists with gtkpod ***", 1)
@@ -914,9 +2371,8 @@ def Command_Update (arg):
 # First, find matching tracks
   toUpdate = []
   trackTree = gpod.itdb_track_id_tree_create(l_itdb)
-  for args in arg[1:]:
-    for t in tracksMatch(itdb, args, 0):
-      toUpdate.append(t.id)
+  for t in tracksMatch(itdb, arg[1:], 0):
+    toUpdate.append(t.id)
 # Now actually update
   print "The following will be updated:"
   print " Title                          Artist                       Rating "
@@ -932,22 +2388,20 @@ def Command_Update (arg):
     else:
       Msg("WARN: %s (%s) not found while updating" % (track.title, track.artist), 1)
     file = str(track.ipod_path)
-    if eyed3.mp3.isMp3File(file): # Open, make sure it's an mp3
-      audioFile = eyed3.mp3.Mp3AudioFile(file, eyed3.id3.ID3_ANY_VERSION)
-      tag = audioFile.tag
-    else:
+    tag = tagCache.get(file)
+    if not tag or not tag['mp3']: # Make sure it's an mp3
       Msg("WARN: %s not an mp3, skipping." % file, 2)
       continue
-    if not tag:
+    if not tag['tagged']:
       Msg("WARN: No ID3 tags for %s, skipping" % file, 1)
       continue
     track.size = fileSize(file)
-    # br = audioFile.bit_rate_str() #broken
-    # br[0] is true if vbr
-    track.bitrate = 128
-    #track.tracklen = audioFile.getPlayTime() * 1000 #broken
-    track.tracklen = 300000
+    track.bitrate = tag['bitrate']
+    track.tracklen = tag['tracklen']
     print " %-30.30s %-25.25s %5d %d" % (track.title, track.artist, track.size/1024, track.bitrate)
+  splUpdate(itdb, toUpdate, set([0x05, 0x0c, 0x0d]))
+  tagCache.evict()
+  tagCache.save()
   writeItdb("db")
   sys.exit(0)
 
@@ -987,18 +2441,14 @@ def Command_Del (arg):
         else:
           toDelete.append(track.id)
     else: # Regex from ipod
-      for regex in arg[1:]:
-        Msg("DEBUG: Deleting with regex: %s" % regex, 2)
-        for t in tracksMatch(itdb, regex, 0x7):
-          toDelete.append(t.id)
-  else: # Delete locally by file/dir/regex
-    for args in arg[1:]:
-      flag = 0x07
-      if type != "ipod":
-        if os.path.exists(args): flag = 0
-        else: flag = 0x7
-      for t in tracksMatch(itdb, args, flag):
+      Msg("DEBUG: Deleting with regex: %s" % arg[1:], 2)
+      for t in tracksMatch(itdb, arg[1:], 0x7):
         toDelete.append(t.id)
+  else: # Delete locally by file/dir/regex
+    files = [a for a in arg[1:] if os.path.exists(a)]
+    regexes = [a for a in arg[1:] if not os.path.exists(a)]
+    for t in tracksMatch(itdb, files, 0) + tracksMatch(itdb, regexes, 0x7):
+      toDelete.append(t.id)
 
 # Now actually delete
 
@@ -1019,14 +2469,14 @@ def Command_Del (arg):
       if ipodDB and ipodMap.has_key(track.id):
         delMap(track)
       if not ipodDB:
-        if extInfo.has_key(id):
-          del extInfo[id]
+        extDrop(id)
       deleteTrack(itdb, track, True)
     else:
       Msg("WARN: Track %d not found while deleting" % id, 1)
   if ipodDB:
-    gpod.itdb_spl_update_all(i_itdb)
+    splUpdateAll(i_itdb)
     writeItdb("ipod")
+    writeMap()
   else:
     writeItdb("db")
   sys.exit(0)
@@ -1039,12 +2489,12 @@ def Command_List (arg):
   argstart = 0
   if arg[0] == "ipod":
     type = "ipod"
-    openItdb(type)
+    openReadOnly(type)
     itdb = i_itdb
     arg = argShift(arg)
   else:
     type = "db"
-    openItdb(type)
+    openReadOnly(type)
     itdb = l_itdb
   if len(arg) < 2:
     arg.append(".*")
@@ -1058,17 +2508,178 @@ def Command_List (arg):
       argstart = 1
   print "|Title                    | Artist            | Album                | Rating | Added On   | Plays | id  | br |"
   print "+-------------------------+-------------------+----------------------+--------+------------+-------+-----+----+"
-  for a in arg[argstart:]:
-    if type != "ipod":
-      if os.path.exists(a): flag = 0
-      else: flag = 0x7
-    for track in tracksMatch(itdb, a, flag):
-      showFile(track)
+  if type != "ipod":
+    files = [a for a in arg[argstart:] if os.path.exists(a)]
+    regexes = [a for a in arg[argstart:] if not os.path.exists(a)]
+  else:
+    files = []
+    regexes = arg[argstart:]
+  for track in tracksMatch(itdb, files, 0) + tracksMatch(itdb, regexes, flag):
+    showFile(track)
 
   sys.exit(0)
 
+# Names of the files in directories, read once per directory and kept
+# current with the names handed out since, so picking a free file name
+# doesn't have to stat candidates one by one
+class DirListing:
+    def __init__(self):
+        self.dirs = {}
+
+    def names(self, dir):
+        if not self.dirs.has_key(dir):
+            try:
+                self.dirs[dir] = set(os.listdir(dir))
+            except OSError:
+                self.dirs[dir] = set()
+        return self.dirs[dir]
+
+    # Takes the first of names not in dir yet
+    def reserve(self, dir, names):
+        taken = self.names(dir)
+        for name in names:
+            if not name in taken:
+                taken.add(name)
+                return name
+
+# Record of the files a dump has copied, in dotitdb/dump.manifest as
+# "<ipod path>\t<local file>\t<size>" lines, so an interrupted dump can
+# pick up where it stopped. Dropped once the local itdb is written.
+class DumpManifest:
+    def __init__(self):
+        self.file = os.path.join(dotitdb, "dump.manifest")
+        self.manifest = None
+
+    # ipod path -> local file, for copies which are still there
+    def load(self):
+        done = {}
+        try:
+            mf = open(self.file, "r")
+        except IOError:
+            return done
+        for line in mf:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 3 or not line.endswith("\n"):
+                continue # Torn last line
+            ipodFile, localFile, size = fields
+            if size.isdigit() and fileSize(localFile) == int(size):
+                done[ipodFile] = localFile
+        mf.close()
+        if done:
+            Msg("INFO: Resuming dump, %d files already copied" % len(done), 1)
+        self.clear()
+        for ipodFile, localFile in done.items():
+            self.log(ipodFile, localFile)
+        return done
+
+    def log(self, ipodFile, localFile):
+        if dryRun:
+            return
+        if not self.manifest:
+            self.manifest = open(self.file, "a")
+        self.manifest.write("%s\t%s\t%d\n" % (ipodFile, localFile, fileSize(localFile)))
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+
+    def clear(self):
+        if self.manifest:
+            self.manifest.close()
+            self.manifest = None
+        if not dryRun and os.path.exists(self.file):
+            os.unlink(self.file)
+
+# Local files by size, for finding iPod files we already have. Files
+# of the same size are compared by fileHash(), then by their full
+# SHA1, both cached across runs. linked and saved count the files
+# linked instead of copied and the bytes that saved.
+class ContentIndex:
+    def __init__(self, files):
+        self.bySize = {}
+        self.linked = 0
+        self.saved = 0
+        for file in files:
+            self.add(file)
+
+    def add(self, file):
+        size = fileSize(file)
+        if size:
+            self.bySize.setdefault(size, []).append(file)
+
+    # A local file with the same contents as file, or None
+    def find(self, file):
+        candidates = self.bySize.get(fileSize(file))
+        if not candidates:
+            return None
+        partial = fileHash(file)
+        digest = None
+        for candidate in list(candidates):
+            if hashCache.get(candidate) != partial:
+                continue
+            if digest is None:
+                digest = fileDigest(file)
+            if digestCache.get(candidate) == digest:
+                return candidate
+        return None
+
+# Linux ioctl cloning a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Make dest share src's data, with a reflink where the filesystem
+# supports them, else a hard link if options.hardlink allows. Returns
+# how, or None if neither worked.
+def linkFile(src, dest):
+  try:
+    fin = open(src, "rb")
+    try:
+      fout = open(dest, "wb")
+      try:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return "reflink"
+      finally:
+        fout.close()
+    finally:
+      fin.close()
+  except (IOError, OSError):
+    if os.path.exists(dest):
+      os.unlink(dest)
+  if not options.hardlink: # Tag edits to one would change both
+    return None
+  try:
+    os.link(src, dest)
+    return "hardlink"
+  except OSError:
+    return None
+
+# Adds the tracks copied by the dump pool to the local itdb. Returns
+# the updated count of copied tracks.
+def dumpFinished(done, manifest, index, count, total):
+  for (track, newtrack), dest, err, linked in done:
+    if err:
+      Msg("WARN: Error copying %s to '%s' (%s), skipping" % (track.ipod_path, dest, err), 1)
+      try:
+        os.unlink(dest)
+      except OSError:
+        0
+      continue
+    manifest.log(str(track.ipod_path), dest)
+    if linked:
+      Msg("DEBUG: %s has the same contents as a local file, %s" % (track.ipod_path, linked), 2)
+      index.linked += 1
+      index.saved += track.size
+    else:
+      index.add(dest)
+    count += 1
+    sys.stdout.write("\r%-30.30s (%-30.30s)      %d/%d     " % (newtrack.title, newtrack.artist, count, total))
+    sys.stdout.flush()
+    gpod.itdb_track_add(l_itdb, newtrack, -1)
+    gpod.itdb_playlist_add_track(gpod.itdb_playlist_mpl(l_itdb), newtrack, -1)
+    extSet(newtrack.id, "filename_locale", newtrack.ipod_path)
+  return count
+
 # Dump tracks and itdb info from ipod, merge with local itdb, don't
-# overwrite existing unless "-f"
+# overwrite existing unless "-f". Files are copied by a pool of
+# options.jobs workers. Copies are recorded in a manifest, so files
+# copied by an interrupted dump are only added to the itdb next time.
 def Command_Dump():
   global ipodMap
   Msg("INFO: Attempting to dump ipod data", 1)
@@ -1080,17 +2691,31 @@ def Command_Dump():
       Msg("ERROR: Can't create %s, exiting" % options.musicdir, 0)
       sys.exit(1)
   count = 0
+  queued = 0
   total = gpod.itdb_tracks_number(i_itdb)
+  manifest = DumpManifest()
+  resumed = manifest.load()
+  listing = DirListing()
+  files = set()
+  if os.path.isdir(options.musicdir):
+    files.update(validFiles([options.musicdir]))
+  for t in gpod.sw_get_tracks(l_itdb):
+    if t.ipod_path and os.path.isfile(t.ipod_path):
+      files.add(str(t.ipod_path))
+  index = ContentIndex(files)
+  pool = DumpPool(options.jobs, index)
+  byId = dict([(t.id, t) for t in gpod.sw_get_tracks(l_itdb)])
+  localPaths = set([str(t.ipod_path) for t in byId.values()])
   for track in gpod.sw_get_tracks(i_itdb):
     ipod_file = gpod.itdb_filename_on_ipod(track)
-    if not os.path.isfile(ipod_file):
-      Msg("WARN: File for %s (%s) not found, skipping." % (track.title, track.artis), 1)
+    if not ipod_file or not os.path.isfile(ipod_file):
+      Msg("WARN: File for %s (%s) not found, skipping." % (track.title, track.artist), 1)
       continue
     album = track.album
     artist = track.artist
     title = track.title
     if ipodMap.has_key(track.id):
-      l_track = gpod.itdb_track_by_id(l_itdb, ipodMap[track.id])
+      l_track = byId.get(ipodMap[track.id])
       if l_track and l_track.artist == artist and l_track.title == title:
         if options.force:
           Msg("WARN: Duplicate found for %s (%s), copying anyway (-f)" % (title, artist), 1)
@@ -1103,40 +2728,50 @@ def Command_Dump():
       artist = "Unknown"
     if title == None:
       title = "Unknown"
+    newtrack = gpod.itdb_track_duplicate(track)
+    if resumed.has_key(str(track.ipod_path)):
+      newtrack.ipod_path = resumed[str(track.ipod_path)]
+      if newtrack.ipod_path in localPaths:
+        continue # Made it into the itdb already
+      count = dumpFinished([((track, newtrack), newtrack.ipod_path, None, None)], manifest, index, count, total)
+      continue
     extension = os.path.splitext(ipod_file)[1]
     if track.track_nr < 1:
-      localFile = "%s%s" % (title, extension)
+      names = ["%s%s" % (title, extension)]
     else:
-      localFile = "%d-%s%s" % (track.track_nr, title, extension)
+      names = ["%d-%s%s" % (track.track_nr, title, extension)]
     localDir = os.path.join(options.musicdir, artist, album)
     if not dryRun and not os.path.isdir(localDir):
       os.makedirs(localDir)
     serial = 1 # Handle identical filenames
-    while os.path.isfile(os.path.join(localDir, localFile)):
-      localFile = "%d-%s-%d%s" % (track.track_nr, title, serial, extension)
-      serial += 1
-    newtrack = gpod.itdb_track_duplicate(track)
+    while True:
+      localFile = listing.reserve(localDir, names)
+      if localFile:
+        break
+      names = ["%d-%s-%d%s" % (track.track_nr, title, i, extension) for i in xrange(serial, serial + 100)]
+      serial += 100
     newtrack.ipod_path = os.path.join(localDir, localFile)
-    if not dryRun:
-      try:
-        shutil.copyfile(ipod_file, newtrack.ipod_path)
-      except:
-        Msg("WARN: Error copying %s to '%s', skipping" % (ipod_file, localFile), 1)
-        continue
-    count += 1
-    sys.stdout.write("\r%-30.30s (%-30.30s)      %d/%d     " % (title, artist, count, total))
-    sys.stdout.flush()
-    gpod.itdb_track_add(l_itdb, newtrack, -1)
-    gpod.itdb_playlist_add_track(gpod.itdb_playlist_mpl(l_itdb), newtrack, -1)
-    extSet(newtrack.id, "filename_locale", newtrack.ipod_path)
-    if options.limit and count >= options.limit:
+    if dryRun:
+      count = dumpFinished([((track, newtrack), newtrack.ipod_path, None, None)], manifest, index, count, total)
+    else:
+      pool.put(((track, newtrack), ipod_file, newtrack.ipod_path))
+      count = dumpFinished(pool.finished(False), manifest, index, count, total)
+    queued += 1
+    if options.limit and queued >= options.limit:
       Msg("INFO: Reached %d files (--limit set)" % options.limit, 2)
       break
+  count = dumpFinished(pool.finished(True), manifest, index, count, total)
+  pool.close()
+  hashCache.save()
+  digestCache.save()
+  if index.linked:
+    Msg("INFO: %d tracks were already here, linked them instead of copying (saved %d Mb)" % (index.linked, index.saved/1024/1024), 1)
   if count:
     Msg("INFO: %d tracks copied. Now copying smart playlists..." % count, 1)
     copySPLs(i_itdb, l_itdb)
     writeItdb("db")
     Msg("Done!", 1)
+  manifest.clear()
   sys.exit(0)
 
 def Command_Evaluate(args):
@@ -1149,13 +2784,13 @@ def Command_Evaluate(args):
     openItdb("ipod")
     itdb = i_itdb
   Msg("INFO: Updating smart playlists...", 1)
-  gpod.itdb_spl_update_all(itdb)
+  mismatches = splUpdateAll(itdb)
   if len(args) == 1:
     writeItdb("db")
   else:
     writeItdb("ipod")
   Msg("Done!", 1)
-  sys.exit(0)
+  sys.exit(mismatches and 1)
 
 # Verify that the db and files look sane
 def Command_Check (arg):
@@ -1166,8 +2801,8 @@ def Command_Check (arg):
     if arg[0] == "ipod":
       checkIpod = True
       musicDir = os.path.join(options.mountpoint,"iPod_Control/Music")
-  songs = []
-  dbfiles = []
+  songs = set()
+  dbfiles = set()
   insync = True
   modified = False
   s = Spinner()
@@ -1176,16 +2811,34 @@ def Command_Check (arg):
     Msg("INFO: Checking playlists...", 1)
     checkSPLs(l_itdb)
     Msg("INFO: Checking tracks...", 1)
+    manifest = {}
+    if not options.full:
+      manifest = readManifest()
+    verified = {}
+    stats = {}
+    for track in gpod.sw_get_tracks(l_itdb):
+      file = str(track.ipod_path)
+      try:
+        st = os.stat(file)
+        stats[file] = (st.st_size, st.st_mtime)
+      except (OSError, TypeError):
+        continue
+    if not options.full:
+      hashCache.prefetch([f for f in stats.keys() if manifest.get(f, (None,))[:2] != stats[f]])
     for track in gpod.sw_get_tracks(l_itdb):
       file = str(track.ipod_path)
       mpl = gpod.itdb_playlist_mpl(l_itdb)
-      if not file or not os.path.isfile(file):
+      if not file or not stats.has_key(file) or not os.path.isfile(file):
         Msg("FIXED: File for %s (%s) not found, deleted from db" % (track.title, file), 1)
         deleteTrack(l_itdb, track, False)
         modified = True
         continue
+      fsize, fmtime = stats[file]
+      hash = extInfo.get(track.id, {}).get("md5_hash")
+      if manifest.get(file) == (fsize, fmtime, hash) and track.size == fsize:
+        Msg("DEBUG: '%s' unchanged since last check" % file, 2)
+        verified[file] = manifest[file]
       else:
-        fsize = fileSize(file)
         if track.size != fsize:
           Msg("DEBUG: DB size of '%s' (%s)mismatched with file. (file/db: %d/%d)" % (file, track.title, fsize, track.size), 1)
           track.size = fsize
@@ -1194,43 +2847,42 @@ def Command_Check (arg):
           Msg("DEBUG: Local file size of '%s' (%s) is zero, deleting" % (file, track.title), 1)
           deleteTrack(l_itdb, track, True)
           modified = True
-        sum = fileHash(file)
+        if options.full:
+          sum = fileHash(file)
+        else:
+          sum = hashCache.get(file)
         if not extInfo.has_key(track.id):
-          extInfo[track.id] = {}
-          extInfo[track.id]['filename_locale'] = file
+          extSet(track.id, 'filename_locale', file)
         if not extInfo[track.id].has_key("md5_hash"):
           Msg("WARN: Hash for '%s' missing." % track.title, 1)
-          extInfo[track.id]['md5_hash'] = None
-        if sum != extInfo[track.id]['md5_hash']:
+        if sum and sum != extInfo[track.id].get('md5_hash'):
           Msg("WARN: Hash for '%s' invalid, updating." % track.title, 1)
-          extInfo[track.id]['md5_hash'] = sum
+          extSet(track.id, 'md5_hash', sum)
+        if fsize >= 10:
+          verified[file] = (fsize, fmtime, sum)
       if file in dbfiles:
         Msg("FIXED: %s appears twice in db, removing one." % file, 1)
         deleteTrack(l_itdb, track, True)
         modified = True
       else:
-        dbfiles.append(file)
+        dbfiles.add(file)
       song = "%s:%s:%s" % (track.title, track.album, track.artist)
       if song in songs:
         Msg("INFO: %s (file %s, id %d) duplicated (songname)" % (song, file, track.id), 2)
-      songs.append(song)
+      songs.add(song)
       if not gpod.itdb_playlist_contains_track(mpl, track):
         print "WARN: %s (%s) not in master playlist. Fixing." % (track.title, track.artist)
         itdb_playlist_add_track(mpl, track, -1)
       s.Print()
+    writeManifest(verified)
   else: # iPod check
-    musicfiles = []
     Msg( "INFO: Scanning music files", 1)
-    musicfiles = validFiles([musicDir])
+    musicfiles = scanMusicDir(musicDir)
     Msg("INFO: Found %d files." % len(musicfiles), 1)
     s.Print()
-    mf = []
-    for files in musicfiles:
-      mf.append(files.lower())
-    musicfiles = mf
     count = 0
     yesremove = False
-    ids = []
+    ids = set()
     openItdb("both")
     mpl = gpod.itdb_playlist_mpl(i_itdb)
     Msg("Checking playlists...", 1)
@@ -1240,21 +2892,21 @@ def Command_Check (arg):
     for track in gpod.sw_get_tracks(i_itdb):
       s.Print()
       file = gpod.itdb_filename_on_ipod(track)
-      if file in dbfiles:
+      if file != None and file.lower() in dbfiles:
         Msg("WARN: %s (file %s) duplicated (filename)" % (track.title, file), 1)
       if file != None:
         realFile = file
         file = file.lower()
-        dbfiles.append(file)
+        dbfiles.add(file)
       else:
         print "Erk, file is none for %s (%s)" % (track.title, track.ipod_path)
       song = "%s:%s:%s" % (track.title, track.album, track.artist)
       if song in songs:
         Msg("WARN: %s (file %s, id %d) duplicated (songname)" % (song, file, track.id), 1)
-      songs.append(song)
+      songs.add(song)
       if track.id in ids:
         Msg("WARN: %s (file %s) duplicated (id)" % (song, file), 1)
-      ids.append(track.id)
+      ids.add(track.id)
       if not ipodMap.has_key(track.id):
         Msg("WARN: Can't find local id for ipod id %d (%s)" % (track.id, track.title), 1)
       else:
@@ -1299,32 +2951,34 @@ def Command_Check (arg):
         except:
           continue
 
-    for mp3 in musicfiles: # Search for orphaned files on the ipod
+    orphans = list(musicfiles - dbfiles) # Search for orphaned files on the ipod
+    orphans.sort()
+    Msg("INFO: Found %d files with no DB entry." % len(orphans), 1)
+    for mp3 in orphans:
       s.Print()
-      if not mp3 in dbfiles:
-        print mp3, "has no DB entry.\nRemove from disk? [y/N/q]"
-        ans = sys.stdin.readline().strip()
-        if ans == "y" or ans == "Y":
-          os.unlink(mp3)
-          print "Removed track."
-          continue
-        if ans == "q":
-          print "Quitting."
-          break
-        insync = False
+      print mp3, "has no DB entry.\nRemove from disk? [y/N/q]"
+      ans = sys.stdin.readline().strip()
+      if ans == "y" or ans == "Y":
+        os.unlink(mp3)
+        print "Removed track."
+        continue
+      if ans == "q":
+        print "Quitting."
+        break
+      insync = False
 
   s.Done()
   Msg( "INFO: Found %d files in DB." % len(dbfiles), 1)
   if modified: # Save DB if anything was changed
     if len(arg) > 1:
-      gpod.itdb_spl_update_all(i_itdb)
+      splUpdateAll(i_itdb)
       if insync:
         Msg( "INFO: iPod is clean and matched to PC..", 1)
       else:
         Msg( "WARN: iPod inconsistencies were found!", 0)
         writeItdb("ipod")
     else:
-      gpod.itdb_spl_update_all(l_itdb)
+      splUpdateAll(l_itdb)
       if insync:
         Msg( "INFO: Disk and DB are fully synchronised.", 1)
       else:
@@ -1332,6 +2986,7 @@ def Command_Check (arg):
         writeItdb("db")
     if not dryRun:
       Msg("INFO: Wrote out new itdb", 1)
+  hashCache.save()
   Msg( "INFO: Finished check.", 1)
   sys.exit(0)
 
@@ -1353,15 +3008,9 @@ def Command_Fixart(arg):
     count += 1
   sys.stdout.write('\n')
   writeItdb("ipod")
+  tagCache.save()
   s.Done()
-  if tmpDir:
-    for file in os.listdir(tmpDir):
-      fl = os.path.join(tmpDir, file)
-      os.unlink(fl)
-    try:
-      os.rmdir(tmpDir)
-    except:
-      0
+  artCache.trim()
   Msg("Done!", 1)
   sys.exit(0)
 
@@ -1371,20 +3020,92 @@ def Command_wrExt(arg):
   writeExt(True)
   sys.exit(0)
 
+# Play statistics of a track that the iPod changes
+def statsKey(t):
+  return (t.rating, t.playcount, t.time_played, t.mark_unplayed, t.bookmark_time)
+
+# iPod tracks whose play statistics changed since the last sync, found
+# by comparing with the copy of the iPod itdb it left behind, plus those
+# mapped to a different local track (or none) at the time. All of them
+# if there's no usable copy or the local itdb has been replaced since.
+def statsDelta(itdb):
+  tracks = itdbTracks(itdb)
+  snapFile = os.path.join(dotitdb, "iTunesDB.ipod")
+  if not os.path.isfile(snapFile):
+    Msg("DEBUG: No copy of the iPod itdb from the last sync, comparing all tracks", 2)
+    return tracks
+  synced = readSyncMap()
+  if not synced or synced[0] != l_itdb.id:
+    Msg("DEBUG: Local itdb or map changed since the last sync, comparing all tracks", 2)
+    return tracks
+  pairs = synced[1]
+  current = mapStore.rev
+  snap = readSnapshot(ipodSnapFile(), snapFile) or readItdbFile(snapFile)
+  if snap:
+    saved = dict([(str(t.ipod_path), statsKey(t)) for t in snap.tracks])
+  else:
+    snap = gpod.itdb_parse_file(snapFile, None)
+    if not snap:
+      Msg("WARN: Can't read %s, comparing all tracks" % snapFile, 1)
+      return tracks
+    saved = {}
+    for t in gpod.sw_get_tracks(snap):
+      saved[str(t.ipod_path)] = statsKey(t)
+    gpod.itdb_free(snap)
+  delta = []
+  for t in tracks:
+    ifile = str(t.ipod_path)
+    if saved.get(ifile) != statsKey(t) or pairs.get(ifile) != current.get(ifile):
+      delta.append(t)
+  Msg("DEBUG: %d of %d iPod tracks changed since the last sync" % (len(delta), len(tracks)), 2)
+  return delta
+
+# The map as sync left it, next to its copy of the iPod itdb
+def syncMapFile():
+  return os.path.join(dotitdb, "map.sync")
+
+# Record the map and the local itdb's id at the end of a sync
+def writeSyncMap():
+  if dryRun:
+    return
+  mf = open(syncMapFile() + ".new", "w")
+  mf.write("%d\n" % l_itdb.id)
+  for l, i in mapStore.map.items():
+    mf.write("%s;%s\n" % (l, i))
+  mf.close()
+  os.rename(syncMapFile() + ".new", syncMapFile())
+
+# (local itdb id, {ipod path: local path}) from writeSyncMap(), or None
+def readSyncMap():
+  try:
+    mf = open(syncMapFile(), "r")
+  except IOError:
+    return None
+  try:
+    dbid = int(mf.readline())
+  except ValueError:
+    mf.close()
+    return None
+  pairs = {}
+  for line in mf:
+    line_split = line.rstrip("\n").split(";")
+    if len(line_split) == 2:
+      pairs[line_split[1]] = line_split[0]
+  mf.close()
+  return (dbid, pairs)
+
 def Command_Diff (arg):
   global l_itdb
   global i_itdb
   global ipodMap
   count = 0
-  openItdb("both")
+  openReadOnly("both")
   Msg("INFO: Showing iPod/local track differences", 2)
-  trackTree = gpod.itdb_track_id_tree_create(l_itdb)
+  byId = dict([(t.id, t) for t in itdbTracks(l_itdb)])
   print "| Title                   | Artist              | Changes                  |"
   print "+-------------------------+---------------------+--------------------------+"
-  for itrack in gpod.sw_get_tracks(i_itdb):
-    ltrack = None
-    if ipodMap.has_key(itrack.id):
-      ltrack = gpod.itdb_track_id_tree_by_id(trackTree, ipodMap[itrack.id])
+  for itrack in statsDelta(i_itdb):
+    ltrack = byId.get(ipodMap.get(itrack.id))
     if not ltrack:
       Msg( "WARN: Can't find local track for id %d (%s)" % (itrack.id, itrack.title), 1)
       continue
@@ -1415,29 +3136,338 @@ def Command_Diff (arg):
     print "%d tracks have updated information." % count
   sys.exit(0)
 
+# Write an iTunesDB of n made up tracks to file with libgpod, with a
+# master playlist of all of them and a playlist of every third one
+def writeTestItdb(file, n):
+  itdb = gpod.itdb_new()
+  mpl = gpod.itdb_playlist_new("iPod", False)
+  gpod.itdb_playlist_set_mpl(mpl)
+  gpod.itdb_playlist_add(itdb, mpl, -1)
+  pl = gpod.itdb_playlist_new("Every third", False)
+  gpod.itdb_playlist_add(itdb, pl, -1)
+  now = int(time.time())
+  for i in xrange(n):
+    t = gpod.itdb_track_new()
+    t.title = "Title %d" % i
+    t.artist = "Artist %d" % (i % 500)
+    t.album = "Album \xc3\xa9t\xc3\xa9 %d" % (i % 2000)
+    t.genre = ("Rock", "Jazz", "Pop")[i % 3]
+    t.filetype = "MPEG audio file"
+    if i % 7:
+      t.comment = "Comment %d" % i
+    t.ipod_path = ":iPod_Control:Music:F%02d:T%06d.mp3" % (i % 50, i)
+    t.size = 3000000 + i
+    t.tracklen = 180000 + i
+    t.track_nr = i % 20 + 1
+    t.cd_nr = 1
+    t.year = 1960 + i % 60
+    t.bitrate = 128
+    t.samplerate = 44100
+    t.rating = i % 6 * 20
+    t.playcount = i % 30
+    t.time_added = now - i * 60
+    if i % 4:
+      t.time_played = now - i * 30
+    t.time_modified = now - i
+    t.bookmark_time = i % 5 * 1000
+    t.BPM = i % 200
+    t.compilation = int(i % 9 == 0)
+    t.mark_unplayed = (i % 3 and 0x01) or 0x02
+    gpod.itdb_track_add(itdb, t, -1)
+    gpod.itdb_playlist_add_track(mpl, t, -1)
+    if i % 3 == 0:
+      gpod.itdb_playlist_add_track(pl, t, -1)
+  ok = gpod.itdb_write_file(itdb, file, None)
+  gpod.itdb_free(itdb)
+  if not ok:
+    Msg("ERROR: Can't write test itdb %s" % file, 0)
+    sys.exit(1)
+
+# Resident memory of this process in Kb, 0 where unknown
+def residentKb():
+  try:
+    f = open("/proc/self/statm")
+    pages = int(f.read().split()[1])
+    f.close()
+  except (IOError, ValueError, IndexError):
+    return 0
+  return pages * os.sysconf("SC_PAGE_SIZE") / 1024
+
+# Check the direct iTunesDB reader against libgpod: read the same file
+# with both, compare every track field and playlist, and report how
+# long each took and the memory it took up. Reads arg[1] if it's an
+# iTunesDB, else writes one of arg[1] (default 1000) tracks with libgpod.
+def Command_Readertest(arg):
+  tmpdir = None
+  if len(arg) > 1 and os.path.isfile(arg[1]):
+    file = arg[1]
+  else:
+    n = 1000
+    if len(arg) > 1:
+      try:
+        n = int(arg[1])
+      except ValueError:
+        showhelp()
+    tmpdir = tempfile.mkdtemp()
+    file = os.path.join(tmpdir, "iTunesDB")
+    Msg("INFO: Writing test itdb of %d tracks" % n, 1)
+    writeTestItdb(file, n)
+  try:
+    fields = sorted(ItdbTrack.ints.keys()) + sorted(ItdbTrack.strings.keys())
+    rss = residentKb()
+    start = time.time()
+    direct = readItdbFile(file)
+    if not direct:
+      Msg("ERROR: Can't read %s directly" % file, 0)
+      sys.exit(1)
+    opened = time.time()
+    drows = [[getattr(t, f) for f in fields] for t in direct.tracks]
+    Msg("INFO: Direct: opened in %.2fs, all fields in %.2fs, %d Kb resident" % (opened - start, time.time() - opened, residentKb() - rss), 1)
+    rss = residentKb()
+    start = time.time()
+    itdb = gpod.itdb_parse_file(file, None)
+    if not itdb:
+      Msg("ERROR: libgpod can't read %s" % file, 0)
+      sys.exit(1)
+    opened = time.time()
+    gtracks = list(gpod.sw_get_tracks(itdb))
+    grows = [[getattr(t, f) for f in fields] for t in gtracks]
+    Msg("INFO: libgpod: parsed in %.2fs, all fields in %.2fs, %d Kb resident" % (opened - start, time.time() - opened, residentKb() - rss), 1)
+
+    diffs = 0
+    if direct.id != itdb.id:
+      Msg("WARN: itdb id 0x%x read directly, 0x%x by libgpod" % (direct.id, itdb.id), 0)
+      diffs += 1
+    if len(drows) != len(grows):
+      Msg("WARN: %d tracks read directly, %d by libgpod" % (len(drows), len(grows)), 0)
+      diffs += 1
+    byId = dict([(row[fields.index("id")], row) for row in grows])
+    for row in drows:
+      grow = byId.get(row[fields.index("id")])
+      if not grow:
+        Msg("WARN: Track %d not read by libgpod" % row[fields.index("id")], 0)
+        diffs += 1
+        continue
+      for f, dvalue, gvalue in zip(fields, row, grow):
+        if ItdbTrack.strings.has_key(f):
+          gvalue = gvalue and str(gvalue) or None
+          dvalue = dvalue or None
+        if dvalue != gvalue:
+          diffs += 1
+          if diffs <= 20:
+            Msg("WARN: Track %d %s: %r read directly, %r by libgpod" % (row[fields.index("id")], f, dvalue, gvalue), 0)
+    dlists = [(pl.id, pl.name, bool(pl.is_spl), [t.id for t in pl.tracks]) for pl in direct.playlists]
+    glists = [(pl.id, str(pl.name), bool(pl.is_spl), [t.id for t in gpod.sw_get_playlist_tracks(pl)]) for pl in gpod.sw_get_playlists(itdb)]
+    if len(dlists) != len(glists):
+      Msg("WARN: %d playlists read directly, %d by libgpod" % (len(dlists), len(glists)), 0)
+      diffs += 1
+    for dlist, glist in zip(dlists, glists):
+      if dlist != glist:
+        Msg("WARN: Playlist %s read directly as %r, by libgpod as %r" % (glist[1], dlist[1:3], glist[1:3]), 0)
+        diffs += 1
+    gpod.itdb_free(itdb)
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir)
+  if diffs:
+    Msg("ERROR: %d differences between the direct reader and libgpod" % diffs, 0)
+    sys.exit(1)
+  print "Direct reader matches libgpod on %d tracks and %d playlists." % (len(drows), len(dlists))
+  sys.exit(0)
+
 def Command_Info(arg):
   global i_itdb
   Msg("WARN: Info command not yet implemented", 1)
   sys.exit(0)
 
+# Whether a command line leaves the databases untouched, so 'serve'
+# can keep them parsed for the next command
+def readOnly(args):
+  n = 0
+  if args and args[0] == "ipod": n += 1
+  if len(args) <= n:
+    return True
+  if args[n] == "playlist":
+    return len(args) <= n + 1 or args[n + 1] in ("list", "rules")
+  return args[n] in ("list", "diff", "info")
+
+# Lets commands served over the socket prompt the client: output is
+# flushed before waiting for an answer
+class ServeInput:
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+
+    def readline(self):
+        self.wfile.flush()
+        return self.rfile.readline()
+
+# Keep the itdbs, map and ext info in memory and run the commands sent
+# by 'podtool -d' over a Unix socket, one at a time. The itdbs are kept
+# after read-only commands and re-read when their files change.
+def Command_Serve(arg):
+  global serving
+  sockFile = options.socket
+  if os.path.exists(sockFile):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(sockFile)
+      Msg("ERROR: podtool is already serving on %s" % sockFile, 0)
+      sys.exit(1)
+    except socket.error:
+      os.unlink(sockFile) # Left over from a crash
+    probe.close()
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  mask = os.umask(0077) # Only we may connect, from the start
+  try:
+    server.bind(sockFile)
+  finally:
+    os.umask(mask)
+  server.listen(5)
+  serving = True
+  Msg("INFO: Serving commands on %s" % sockFile, 1)
+  try:
+    while True:
+      conn = server.accept()[0]
+      try:
+        serveRequest(conn)
+      except Exception:
+        traceback.print_exc()
+      conn.close()
+  except KeyboardInterrupt:
+    Msg("INFO: Stopped serving", 1)
+  server.close()
+  os.unlink(sockFile)
+  for which in resident.keys():
+    dropItdb(which)
+  sys.exit(0)
+
+# Runs one command line sent by sendToDaemon(), with its output going
+# back over conn followed by the exit code
+def serveRequest(conn):
+  global options
+  global args
+  global extStore
+  global extInfo
+  global startTime
+  startTime = time.time()
+  rfile = conn.makefile("rb")
+  wfile = conn.makefile("wb")
+  request = json.loads(rfile.readline() or "null")
+  if not request:
+    return
+  saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+  sys.stdin = ServeInput(rfile, wfile)
+  sys.stdout = wfile
+  sys.stderr = wfile
+  args = []
+  code = 0
+  try:
+    try:
+      os.chdir(request["cwd"])
+      (options, args) = parser.parse_args([a.encode("utf-8") for a in request["argv"]])
+      applyOptions()
+      ipodMap.clear()
+      del timings[:]
+      if extStore.text != options.dbname + ".ext":
+        dropItdb("db")
+        extStore = ExtStore(options.dbname + ".ext")
+        extInfo = extStore.records
+      if not args or args[0] == "serve":
+        showhelp()
+      runCommand(args)
+    except SystemExit, e:
+      code = e.code
+      if code is None:
+        code = 0
+      elif not isinstance(code, int):
+        print code
+        code = 1
+    except Exception:
+      traceback.print_exc()
+      code = 1
+    if options.timings:
+      reportTimings()
+    if not readOnly(args):
+      for which in resident.keys():
+        dropItdb(which)
+    # Caches keyed by id(itdb) only hold for itdbs still alive
+    live = set([id(itdb) for files, stamps, itdb in resident.values()])
+    for cache in (trackIndexes, playlistRegistries):
+      for key in cache.keys():
+        if not key in live:
+          del cache[key]
+    wfile.write("\0exit %d\n" % code)
+    wfile.flush()
+  finally:
+    sys.stdin, sys.stdout, sys.stderr, cwd = saved
+    os.chdir(cwd)
+
+# Runs the command line argv in a running 'podtool serve', relaying
+# stdin and output. Returns its exit code, or None if nothing is
+# serving.
+def sendToDaemon(argv):
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(options.socket)
+  except socket.error:
+    Msg("DEBUG: Nothing serving on %s, running here" % options.socket, 2)
+    return None
+  conn.sendall(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+  feeder = threading.Thread(target=feedDaemon, args=(conn,))
+  feeder.setDaemon(True)
+  feeder.start()
+  data = ""
+  while True:
+    chunk = conn.recv(65536)
+    if not chunk:
+      break
+    data += chunk
+    end = data.find("\0") # Start of the exit code
+    if end < 0:
+      end = len(data)
+    sys.stdout.write(data[:end])
+    sys.stdout.flush()
+    data = data[end:]
+  conn.close()
+  if not data.startswith("\0exit "):
+    Msg("ERROR: Lost connection to podtool serving on %s" % options.socket, 0)
+    return 1
+  return int(data[6:])
+
+def feedDaemon(conn):
+  try:
+    while True:
+      line = sys.stdin.readline()
+      if not line:
+        break
+      conn.sendall(line)
+    conn.shutdown(socket.SHUT_WR)
+  except socket.error:
+    0
+
 def Command_Playlist(arg):
   Msg("DEBUG: Playlist command: %s" % arg, 2)
   global l_itdb
   global i_itdb
   if arg[0] == "ipod": 
-    openItdb("ipod")
-    arg = argShift(arg)
-    itdb = i_itdb
     where = "ipod"
+    arg = argShift(arg)
   else: 
-    openItdb("db")
-    itdb = l_itdb
     where = "db"
+  if len(arg) > 1 and arg[1] == "list":
+    openReadOnly(where)
+  else:
+    openItdb(where)
+  if where == "ipod":
+    itdb = i_itdb
+  else:
+    itdb = l_itdb
   if len(arg) > 1:
     cmd = arg[1]
     if cmd == "list":
       if len(arg) > 2:
-        playlist = gpod.itdb_playlist_by_name(itdb, arg[2])
+        playlist = playlistByName(itdb, arg[2])
         if not playlist:
           Msg("ERROR: Playlist '%s' doesn't exist!" % arg[2], 0)
           sys.exit(1)
@@ -1446,7 +3476,7 @@ def Command_Playlist(arg):
         action = "showlists"
     elif cmd == "rules":
       if len(arg) > 2:
-        playlist = gpod.itdb_playlist_by_name(itdb, arg[2])
+        playlist = playlistByName(itdb, arg[2])
         if not playlist:
           Msg("ERROR: Playlist '%s' doesn't exist!" % arg[2], 0)
           sys.exit(1)
@@ -1460,7 +3490,7 @@ def Command_Playlist(arg):
     elif cmd == "play":
       argLen(arg, 3)
       action = "play"
-      playlist = gpod.itdb_playlist_by_name(itdb, arg[2])
+      playlist = playlistByName(itdb, arg[2])
     elif cmd == "create":
       argLen(arg, 3)
       action = "create"
@@ -1480,17 +3510,16 @@ def Command_Playlist(arg):
     else:
       showhelp()
   if action == "showlists":
-    print "| Name              | Items | Size   |Smart? |"
-    print "+-------------------+-------+--------+-------+"
-    for playlist in gpod.sw_get_playlists(itdb):
-      size = 0
-      for track in gpod.sw_get_playlist_tracks(playlist):
-        size += track.size
+    stats = playlistStats(itdb)
+    print "| Name              | Items | Size   | Length   |Smart? |"
+    print "+-------------------+-------+--------+----------+-------+"
+    for playlist in itdbPlaylists(itdb):
+      count, size, length = stats[playlist.id]
       if playlist.is_spl:
         isspl = "Yes"
       else:
         isspl = "No"
-      print " %-19.19s  %4d   %5dMb    %3s " % (playlist.name, len(gpod.sw_get_playlist_tracks(playlist)), size/1024/1024, isspl)
+      print " %-19.19s  %4d   %5dMb  %9s    %3s " % (playlist.name, count, size/1024/1024, prettyTime(length), isspl)
   elif action == "play":
     for track in gpod.sw_get_playlist_tracks(playlist):
       file = track.ipod_path
@@ -1506,7 +3535,7 @@ def Command_Playlist(arg):
     print "Tracks in playlist '%s':" % playlist.name
     print "| Title                       | Artist            | Rating | Length |Plays|"
     print "+-----------------------------+-------------------+--------+--------+-----+"
-    for t in gpod.sw_get_playlist_tracks(playlist):
+    for t in playlistTracks(playlist):
       print " %-30.30s %-20.20s %-5.5s %8s   %3d" % (t.title, t.artist, stars(t), prettyTime(t.tracklen),t.playcount)
     sys.exit(0)
   elif action == "showspl" or action == "showallspls":
@@ -1524,11 +3553,11 @@ def Command_Playlist(arg):
             rule = gpod.sw_get_rule(playlist.splrules.rules, i)
             showRule(itdb, rule)
   elif action == "create":
-    if gpod.itdb_playlist_by_name(itdb, name):
+    if playlistByName(itdb, name):
       Msg("ERROR: Playlist '%s' already exists!" % name, 0)
       sys.exit(1)
     playlist = gpod.itdb_playlist_new(name, False)
-    gpod.itdb_playlist_add(itdb, playlist, -1)
+    playlistAdd(itdb, playlist, -1)
     if type == "podcast": 
       gpod.itdb_playlist_set_podcasts(playlist)
       ispodcast = " and set as Podcast list"
@@ -1537,7 +3566,7 @@ def Command_Playlist(arg):
     Msg("INFO: Created playlist '%s' %s" % (name, ispodcast), 1)
   elif action == "delete":
     name = arg[2]
-    playlist = gpod.itdb_playlist_by_name(itdb, name)
+    playlist = playlistByName(itdb, name)
     if not playlist:
       Msg("ERROR: Playlist '%s' doesn't exists!", 0)
       sys.exit(1)
@@ -1549,19 +3578,17 @@ def Command_Playlist(arg):
       for track in tracks:
         Msg("INFO: Deleting playlist tracks and files...", 1)
         deleteTrack(itdb, track, True)
-    gpod.itdb_playlist_remove(playlist)
+    playlistRemove(itdb, playlist)
     writeItdb(where)
     Msg("INFO: Deleted playlist '%s'" % name, 1)
   elif action == "addto":
     name = arg[2]
     tracks = []
-    playlist = gpod.itdb_playlist_by_name(itdb, name)
+    playlist = playlistByName(itdb, name)
     if not playlist:
       Msg("ERROR: Playlist '%s' doesn't exist!" % name, 0)
       sys.exit(1)
-    for pattern in arg[3:]:
-      for track in tracksMatch(itdb, pattern, 0x7):
-        tracks.append(track)
+    tracks = tracksMatch(itdb, arg[3:], 0x7)
     if not tracks:
       Msg("WARN: No tracks matching '%s'" % arg[3:], 1)
       sys.exit(0)
@@ -1578,13 +3605,11 @@ def Command_Playlist(arg):
   elif action == "remove":
     name = arg[2]
     tracks = []
-    playlist = gpod.itdb_playlist_by_name(itdb, name)
+    playlist = playlistByName(itdb, name)
     if not playlist:
       Msg("ERROR: Playlist '%s' doesn't exist!" % name, 0)
       sys.exit(1)
-    for pattern in arg[3:]:
-      for track in tracksMatch(itdb, pattern, 0x7):
-        tracks.append(track)
+    tracks = tracksMatch(itdb, arg[3:], 0x7)
     if not tracks:
       Msg("WARN: No tracks matching '%s'" % arg[3:], 1)
       sys.exit(0)
@@ -1606,6 +3631,496 @@ def Command_Playlist(arg):
   sys.exit(0)
 
 
+# Works out what a sync has to do. All the lookups go through hashed
+# indexes built once up front, so planning is linear in the number of
+# local and iPod tracks rather than their product:
+#   wanted:   local ids in synced playlists (playlist membership set)
+#   keep:     local id -> iPod track already on the iPod
+#   ipodids:  iPod id -> local id, for mapped iPod tracks
+# copy is the ordered list of wanted ids, toipod the ones still missing
+# from the iPod and delete the mapped iPod tracks no longer wanted.
+# Unmapped iPod tracks weren't put there by sync and are left alone.
+class SyncPlan:
+    def __init__(self):
+        self.copy = []
+        self.wanted = set()
+        self.podcasts = set()
+        self.keep = {}
+        self.ipodids = {}
+        self.toipod = []
+        self.delete = []
+        self.totalsize = 0
+        self.copybytes = 0
+        self.stalebytes = 0
+        self.unmapped = 0
+        self.weights = {} # local id -> weight of its most valued playlist
+        self.sizes = {}
+        weights = playlistWeights()
+
+        # Get tracks to copy from local playlists which also exist on the
+        # ipod, but not master
+        ipodLists = set([pl.name for pl in gpod.sw_get_playlists(i_itdb)])
+        for playlist in gpod.sw_get_playlists(l_itdb):
+            if gpod.itdb_playlist_is_mpl(playlist):
+                continue
+            if not playlist.is_spl or not playlist.name in ipodLists:
+                continue
+            Msg("Playlist: %s (%d tracks)" % (playlist.name, gpod.itdb_playlist_tracks_number(playlist)), 1)
+            weight = weights.get(playlist.name, 1)
+            for track in gpod.sw_get_playlist_tracks(playlist):
+                self.want(track, weight)
+
+        podcasts = gpod.itdb_playlist_podcasts(l_itdb)
+        if podcasts:
+            Msg("Playlist: %s (%d tracks)" % (podcasts.name, gpod.itdb_playlist_tracks_number(podcasts)), 1)
+            weight = weights.get(podcasts.name, 1)
+            for track in gpod.sw_get_playlist_tracks(podcasts):
+                if track.mark_unplayed == 0x02 and self.want(track, weight):
+                    self.podcasts.add(track.id)
+        if not gpod.itdb_playlist_podcasts(i_itdb):
+            Msg("WARN: iPod doesn't have a Podcast playlist", 1)
+
+        # If ipod tracks arent wanted, remove them
+        for itrack in gpod.sw_get_tracks(i_itdb):
+            lid = ipodMap.get(itrack.id, 0)
+            if lid:
+                self.ipodids[itrack.id] = lid
+            if lid and lid in self.wanted:
+                self.keep.setdefault(lid, itrack)
+            elif lid:
+                self.delete.append(itrack)
+                self.stalebytes += itrack.size
+            else:
+                self.unmapped += 1 # Not ours, left on the iPod
+
+        # Whatever is wanted but not kept needs copying
+        self.copybytes = self.totalsize
+        for tid in self.copy:
+            if tid in self.keep:
+                self.copybytes -= self.keep[tid].size
+            else:
+                self.toipod.append(tid)
+
+    # Adds a local track to the wanted set, returns False if already there
+    def want(self, track, weight):
+        self.weights[track.id] = max(weight, self.weights.get(track.id, weight))
+        if track.id in self.wanted:
+            return False
+        self.wanted.add(track.id)
+        self.sizes[track.id] = track.size
+        self.copy.append(track.id)
+        self.totalsize += track.size
+        return True
+
+# Playlist weights from --weight NAME=WEIGHT options
+def playlistWeights():
+  weights = {}
+  for opt in options.weights:
+    name, sep, weight = opt.rpartition("=")
+    try:
+      weights[name] = int(weight)
+    except ValueError:
+      sep = ""
+    if not sep or not name:
+      Msg("ERROR: Bad playlist weight '%s', expected NAME=WEIGHT" % opt, 0)
+      sys.exit(1)
+  return weights
+
+# Fits the tracks a SyncPlan wants to copy into the space the iPod will
+# have once stale tracks are gone, less options.reserve Mb, with file
+# sizes rounded up to whole clusters. Tracks are taken greedily by
+# weight (value per byte), in playlist order within a weight, skipping
+# those that no longer fit. chosen is the copy order, dropped the rest.
+class CapacityPlan:
+    def __init__(self, plan, free):
+        self.cluster = clusterSize(options.mountpoint)
+        self.reserve = options.reserve * 1024 * 1024
+        self.free = free - self.reserve
+        for itrack in plan.delete:
+            self.free += diskUsage(self.cluster, itrack.size)
+        self.chosen = []
+        self.dropped = []
+        self.chosenbytes = 0
+        self.droppedbytes = 0
+        left = self.free
+        order = sorted(plan.toipod, key=lambda tid: -plan.weights[tid])
+        for tid in order:
+            size = diskUsage(self.cluster, plan.sizes[tid])
+            if size <= left:
+                left -= size
+                self.chosen.append(tid)
+                self.chosenbytes += size
+            else:
+                self.dropped.append(tid)
+                self.droppedbytes += size
+
+# libc copy functions for copyFile(): (name, function, errno getter)
+# for those there are, set up on first use
+copyFuncs = None
+
+def kernelCopyFuncs():
+  global copyFuncs
+  if copyFuncs is None:
+    funcs = []
+    try:
+      import ctypes
+      libc = ctypes.CDLL(None, use_errno=True)
+      for name, args in (("copy_file_range", (ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)),
+                         ("sendfile", (ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t))):
+        func = getattr(libc, name, None)
+        if func:
+          func.argtypes = args
+          func.restype = ctypes.c_ssize_t
+          funcs.append((name, func, ctypes.get_errno))
+    except (ImportError, OSError): # Copies go through shutil
+      0
+    copyFuncs = funcs
+  return copyFuncs
+
+# Copy file src to dest inside the kernel, with copy_file_range() or
+# else sendfile(), falling back to shutil where neither works. Doesn't
+# hold the interpreter lock while copying.
+def copyFile(src, dest):
+  funcs = kernelCopyFuncs()
+  if funcs:
+    fin = open(src, "rb")
+    fout = open(dest, "wb")
+    try:
+      size = os.fstat(fin.fileno()).st_size
+      for name, func, geterrno in funcs:
+        left = size
+        while left > 0:
+          chunk = min(left, 1 << 30)
+          if name == "sendfile":
+            n = func(fout.fileno(), fin.fileno(), None, chunk)
+          else:
+            n = func(fin.fileno(), None, fout.fileno(), None, chunk, 0)
+          if n < 0:
+            err = geterrno()
+            if left == size and err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+              break # Not for these files, try the next way
+            raise OSError(err, os.strerror(err))
+          if n == 0:
+            break # src shrank
+          left -= n
+        if left < size or not size:
+          return
+    finally:
+      fin.close()
+      fout.close()
+  shutil.copyfile(src, dest)
+
+# Bounded pool of worker threads copying files. put() queues a job,
+# blocking while the pool is busy, and finished() hands back the
+# results of process() for completed ones.
+class CopyPool:
+    def __init__(self, jobs):
+        jobs = max(1, jobs)
+        self.todo = Queue.Queue(jobs)
+        self.done = Queue.Queue()
+        self.pending = 0
+        self.workers = []
+        for i in range(jobs):
+            t = threading.Thread(target=self.work)
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+
+    def put(self, job):
+        self.pending += 1
+        self.todo.put(job)
+
+    def work(self):
+        while True:
+            job = self.todo.get()
+            if not job:
+                return
+            try:
+                ret = self.process(job)
+            except Exception, e: # Every job needs a result for finished()
+                ret = self.failed(job, e)
+            self.done.put(ret)
+
+    # Copies (key, src, dest), returns (key, dest, error or None)
+    def process(self, job):
+        key, src, dest = job
+        err = None
+        try:
+            copyFile(src, dest)
+        except (IOError, OSError), e:
+            err = e
+        return (key, dest, err)
+
+    # Result for a job process() raised e on
+    def failed(self, job, e):
+        key, src, dest = job
+        return (key, dest, e)
+
+    # Returns finished jobs, waiting for all of them if wait is set
+    def finished(self, wait):
+        ret = []
+        while self.pending:
+            try:
+                ret.append(self.done.get(wait, 1))
+            except Queue.Empty:
+                if wait:
+                    continue # Waiting in steps lets ^C through
+                break
+            self.pending -= 1
+        return ret
+
+    def close(self):
+        for t in self.workers:
+            self.todo.put(None)
+        for t in self.workers:
+            t.join()
+
+# Pool of workers transferring tracks to the iPod. Workers copy the
+# file and extract its artwork, so one track's artwork is parsed and
+# the next file read while the current one is written. Anything
+# touching libgpod stays with the caller: submit() picks the
+# destination, finished() hands back completed transfers.
+# One pool per device, its size limits concurrent writes to it.
+class Transfer(CopyPool):
+    def __init__(self, jobs, journal):
+        CopyPool.__init__(self, jobs)
+        self.journal = journal
+
+    # Queue track for copying as t2, blocks while the pool is busy
+    def submit(self, track, t2):
+        dest = None
+        if not dryRun:
+            dest = gpod.itdb_cp_get_dest_filename(t2, options.mountpoint, track.ipod_path, None)
+            if not dest:
+                return False
+            self.journal.reserve(dest)
+            open(dest, "wb").close() # Reserve the name for this track
+        self.put((track, t2, str(track.ipod_path), dest))
+        return True
+
+    def process(self, job):
+        track, t2, src, dest = job
+        err = None
+        if dest:
+            try:
+                copyFile(src, dest)
+            except (IOError, OSError), e:
+                err = e
+        thumb = thumbfile(src)
+        return (track, t2, dest, thumb, err)
+
+    def failed(self, job, e):
+        track, t2, src, dest = job
+        return (track, t2, dest, None, e)
+
+# Copies files for dump, linking them to local files with the same
+# contents instead where there are some
+class DumpPool(CopyPool):
+    def __init__(self, jobs, index):
+        CopyPool.__init__(self, jobs)
+        self.index = index
+
+    # Returns (key, dest, error or None, how dest was linked or None)
+    def process(self, job):
+        key, src, dest = job
+        err = None
+        linked = None
+        try:
+            same = self.index.find(src)
+            if same:
+                linked = linkFile(same, dest)
+            if not linked:
+                copyFile(src, dest)
+        except (IOError, OSError), e:
+            err = e
+        return (key, dest, err, linked)
+
+    def failed(self, job, e):
+        key, src, dest = job
+        return (key, dest, e, None)
+
+# Adds tracks copied by Transfer to the ipod itdb, checkpointing it
+# through journal. Returns the updated count of copied tracks.
+def syncFinished(done, podcastlist, copied, numtocopy, journal):
+  for track, t2, dest, thumb, err in done:
+    journal.release(dest)
+    if err:
+      Msg("WARN: Error copying %s (%s), skipping" % (track.ipod_path, err), 0)
+      try:
+        os.unlink(dest)
+      except:
+        0
+      continue
+    if dest and not gpod.itdb_cp_finalize(t2, options.mountpoint, dest, None):
+      Msg("WARN: Couldn't finalize copy of %s, skipping" % track.ipod_path, 0)
+      continue
+    copied += 1
+    gpod.itdb_track_add(i_itdb, t2, -1)
+    gpod.itdb_playlist_add_track(gpod.itdb_playlist_mpl(i_itdb), t2, -1)
+    if track.id in podcastlist:
+      gpod.itdb_playlist_add_track(gpod.itdb_playlist_podcasts(i_itdb), t2, -1)
+      Msg("INFO: Added '%s' to podcast playlist" % track.title, 1)
+    if thumb:
+      gpod.itdb_track_set_thumbnails(t2, thumb)
+      wthumb = "( +thumb )"
+    else:
+      wthumb = ""
+    Msg( "INFO: Copying: %s (%s) %s (%d/%d)" % (track.title, track.artist, wthumb, copied, numtocopy), 1)
+    setMap(track, t2) # Set ipod->local mapping
+    extSet(track.id, "filename_ipod", t2.ipod_path)
+    journal.log(track, t2, track.id in podcastlist)
+    if journal.due():
+      journal.checkpoint()
+  return copied
+
+
+# Write-ahead journal of the tracks a sync has copied to the iPod. Each
+# finished copy is logged with its mapping before the iPod itdb knows
+# about it, so a sync interrupted before the next checkpoint can resume
+# from the journal instead of copying those tracks again. The iPod itdb
+# is checkpointed every options.checkpoint seconds or
+# options.checkpointmb Mb copied, after which the journal starts over.
+# The files Transfer reserves on the iPod are journaled too, so those
+# an interrupted sync never finished can be removed.
+class TransferJournal:
+    def __init__(self):
+        self.file = os.path.join(dotitdb, "transfer.journal")
+        self.journal = None
+        self.since = time.time()
+        self.bytes = 0
+        self.reserved = set() # Files on the iPod not copied yet
+
+    # Entries of an interrupted sync: (local path, ipod path, size,
+    # podcast), and the files it reserved on the iPod
+    def load(self):
+        entries = []
+        reserved = set()
+        try:
+            jf = open(self.file, "r")
+        except IOError:
+            return entries, reserved
+        for line in jf:
+            fields = line.rstrip("\n").split("\t")
+            if not line.endswith("\n"):
+                continue # Torn last line
+            if len(fields) == 2 and fields[0] == "reserve":
+                reserved.add(os.path.normpath(fields[1]))
+                continue
+            if len(fields) != 4:
+                continue
+            try:
+                entries.append((fields[0], fields[1], int(fields[2]), fields[3] == "1"))
+            except ValueError:
+                continue
+        jf.close()
+        return entries, reserved
+
+    def write(self, line):
+        if not self.journal:
+            self.journal = open(self.file, "a")
+        self.journal.write(line + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    # Log dest as taken on the iPod, before the file is created
+    def reserve(self, dest):
+        self.reserved.add(dest)
+        if not dryRun:
+            self.write("reserve\t%s" % dest)
+
+    # dest has been copied, or removed after an error
+    def release(self, dest):
+        self.reserved.discard(dest)
+
+    def log(self, track, t2, podcast):
+        self.bytes += track.size
+        if dryRun:
+            return
+        self.write("%s\t%s\t%d\t%d" % (track.ipod_path, t2.ipod_path, track.size, podcast))
+
+    def due(self):
+        return time.time() - self.since >= options.checkpoint or \
+               self.bytes >= options.checkpointmb * 1024 * 1024
+
+    # Write the iPod itdb; everything logged so far is then in it, and
+    # in the ext journal
+    def checkpoint(self):
+        Msg("DEBUG: Checkpointing iPod itdb (%d Mb copied in %d s)" % (self.bytes/1024/1024, time.time() - self.since), 2)
+        writeItdb("ipod")
+        extStore.sync()
+        self.clear()
+        for dest in self.reserved: # Still being copied
+            if not dryRun:
+                self.write("reserve\t%s" % dest)
+
+    def clear(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if not dryRun and os.path.exists(self.file):
+            os.unlink(self.file)
+        self.start()
+
+    # Start counting towards the next checkpoint
+    def start(self):
+        self.since = time.time()
+        self.bytes = 0
+
+    # Put the tracks copied by an interrupted sync back into the iPod
+    # itdb and map. Returns the number of tracks recovered.
+    def resume(self):
+        entries, reserved = self.load()
+        for lfile, ifile, size, podcast in entries:
+            reserved.discard(os.path.normpath(os.path.join(options.mountpoint, *ifile.split(":")[1:])))
+        removed = 0
+        for dest in reserved:
+            if os.path.exists(dest):
+                Msg("DEBUG: Removing unfinished copy %s" % dest, 2)
+                if not dryRun:
+                    os.unlink(dest)
+                removed += 1
+        if removed:
+            Msg("INFO: Removed %d unfinished copies left by an interrupted sync" % removed, 1)
+        if not entries:
+            self.clear()
+            return 0
+        local = {}
+        for track in gpod.sw_get_tracks(l_itdb):
+            local[str(track.ipod_path)] = track
+        onipod = set([str(t.ipod_path) for t in gpod.sw_get_tracks(i_itdb)])
+        mpl = gpod.itdb_playlist_mpl(i_itdb)
+        podcasts = gpod.itdb_playlist_podcasts(i_itdb)
+        resumed = 0
+        for lfile, ifile, size, podcast in entries:
+            track = local.get(lfile)
+            if ifile in onipod or not track:
+                continue
+            dest = os.path.join(options.mountpoint, *ifile.split(":")[1:])
+            if fileSize(dest) != size:
+                Msg("WARN: Copy of %s from interrupted sync is gone, will copy again" % lfile, 1)
+                continue
+            t2 = gpod.itdb_track_duplicate(track)
+            t2.ipod_path = ifile
+            t2.transferred = True
+            gpod.itdb_track_add(i_itdb, t2, -1)
+            gpod.itdb_playlist_add_track(mpl, t2, -1)
+            if podcast and podcasts:
+                gpod.itdb_playlist_add_track(podcasts, t2, -1)
+            thumb = thumbfile(lfile)
+            if thumb:
+                gpod.itdb_track_set_thumbnails(t2, thumb)
+            setMap(track, t2)
+            extSet(track.id, "filename_ipod", ifile)
+            ipodMap[t2.id] = track.id
+            onipod.add(ifile)
+            resumed += 1
+        Msg("INFO: Resumed %d tracks copied by an interrupted sync" % resumed, 1)
+        if resumed:
+            self.checkpoint()
+        else:
+            self.clear()
+        return resumed
+
 # Python cookbook 1.9 
 def Command_Sync (arg):
   Msg( "DEBUG: Will sync: %s" % arg, 2)
@@ -1615,7 +4130,6 @@ def Command_Sync (arg):
   global ipodDbname
   global dotitdb
   global ipodMap
-  global tmpDir
   meta = False
   if len(arg) > 1:
     if arg[1] == "meta":
@@ -1631,7 +4145,9 @@ def Command_Sync (arg):
   trackTree = gpod.itdb_track_id_tree_create(l_itdb)
   # Copy iPod ratings, playcount info to local db
   changed = 0
-  for itrack in gpod.sw_get_tracks(i_itdb):
+  changedIds = []
+  changedFields = set() # Smart playlist rule fields touched
+  for itrack in statsDelta(i_itdb):
     ltrack = None
     if ipodMap.has_key(itrack.id):
       ltrack = gpod.itdb_track_id_tree_by_id(trackTree, ipodMap[itrack.id])
@@ -1648,13 +4164,16 @@ def Command_Sync (arg):
       if ltrack.rating != itrack.rating:
         chstr += "%s -> %s, " % (stars(ltrack), stars(itrack))
         ltrack.rating = itrack.rating
+        changedFields.add(0x19)
         tchanged = 1
       if ltrack.playcount != itrack.playcount:
         chstr += "%d -> %d plays" % (ltrack.playcount, itrack.playcount)
         ltrack.playcount = itrack.playcount
+        changedFields.add(0x16)
         tchanged = 1
       if ltrack.time_played != itrack.time_played:
         ltrack.time_played = itrack.time_played
+        changedFields.add(0x17)
         tchanged = 1
       if ltrack.mark_unplayed != itrack.mark_unplayed:
         if itrack.mark_unplayed < 255:
@@ -1665,98 +4184,62 @@ def Command_Sync (arg):
         tchanged = 1
       if tchanged:
         changed += 1
+        changedIds.append(ltrack.id)
         chstr += ")"
         Msg(chstr,2)
 
   if changed:
     Msg("INFO: Merged stats from %d tracks" % changed, 1)
 
-  # Evaluate local playlists
-  gpod.itdb_spl_update_all(l_itdb)
+  # Evaluate the local playlists affected by the merge
+  splUpdate(l_itdb, changedIds, changedFields)
 
-  writeItdb("db")
+  if changed:
+    writeItdb("db")
+  else:
+    Msg("INFO: No stats changed on the iPod, not writing local itdb", 1)
   if meta:
     Msg("INFO: Metadata sync done.", 1)
     sys.exit(0)
 
-  copytoipod = []
-  delfromipod = []
-  numtocopy = 0
-  totalsize = 0
-  
-  Msg("DEBUG: Determining tracks to copy to ipod", 2)
-
-  # Get tracks to copy from local playlists
-  for playlist in gpod.sw_get_playlists(l_itdb):
-    # Copy from playlists in ipod, but not master
-    if gpod.itdb_playlist_is_mpl(playlist):
-      continue
-    for pl in gpod.sw_get_playlists(i_itdb):
-      if pl.name == playlist.name:
-        break
-    else:
-      continue
-    if playlist.is_spl:
-      Msg("Playlist: %s (%d tracks)" % (playlist.name, gpod.itdb_playlist_tracks_number(playlist)), 1)
-      for track in gpod.sw_get_playlist_tracks(playlist):
-        tid = track.id
-        if not tid in copytoipod:
-          copytoipod.append(tid)
-          tr = gpod.itdb_track_id_tree_by_id(trackTree, tid)
-          totalsize += tr.size
-          numtocopy += 1
-
-  podcastlist = []
-  podcasts = gpod.itdb_playlist_podcasts(l_itdb)
-  if podcasts:
-    Msg("Playlist: %s (%d tracks)" % (podcasts.name, gpod.itdb_playlist_tracks_number(podcasts)), 1)
-    for track in gpod.sw_get_playlist_tracks(podcasts):
-      if track.mark_unplayed == 0x02:
-        if not track.id in copytoipod:
-          copytoipod.append(track.id)
-          totalsize += track.size
-          numtocopy += 1
-          podcastlist.append(track.id)
-  if not gpod.itdb_playlist_podcasts(i_itdb):
-    Msg("WARN: iPod doesn't have a Podcast playlist", 1)
-
-  # If ipod tracks arent in 'to copy' list, remove them
-  stalebytes = 0
-  for itrack in gpod.sw_get_tracks(i_itdb):
-    if ipodMap.has_key(itrack.id):
-      if not ipodMap[itrack.id] in copytoipod:
-        delfromipod.append(itrack)
-        stalebytes += itrack.size
-    else:
-      delfromipod.append(itrack)
+  journal = TransferJournal()
+  journal.resume()
 
-  Msg("INFO: Will remove %d stale tracks from iPod (%d Mb)" % (len(delfromipod), stalebytes/1024/1024), 1)
+  Msg("DEBUG: Determining tracks to copy to ipod", 2)
+  plan = SyncPlan()
+  copytoipod = plan.copy
+  delfromipod = plan.delete
+  trackstoipod = plan.toipod
+  podcastlist = plan.podcasts
+  numtocopy = len(trackstoipod)
+  totalsize = plan.totalsize
+  copybytes = plan.copybytes
 
-  # Determine what tracks to copy to ipod
-  trackstoipod = []
-  copybytes = totalsize
-  for tid in copytoipod:
-    for itrack in gpod.sw_get_tracks(i_itdb):
-      if ipodMap.has_key(itrack.id):
-        if tid == ipodMap[itrack.id]:
-          numtocopy -= 1
-          copybytes -= itrack.size
-          break  # Skip if track's already on ipod
-    else:
-      trackstoipod.append(tid)
+  Msg("INFO: Will remove %d stale tracks from iPod (%d Mb)" % (len(delfromipod), plan.stalebytes/1024/1024), 1)
+  if plan.unmapped:
+    Msg("INFO: Leaving %d iPod tracks not in the map alone (see makemap)" % plan.unmapped, 1)
 
-  fs_blocks = diskSpace(options.mountpoint)
   Msg( "INFO: Preparing to copy %d new tracks (%d Mb, total %d Mb)" % (numtocopy, copybytes/1024/1024, totalsize/1024/1024), 1)
-  if totalsize > (fs_blocks - 13000000):
-    Msg( "WARN: Insufficient space to copy (need %dMb, have %d)" % (totalsize/1024/1024, fs_blocks/1024/1024), 0)
+  capacity = CapacityPlan(plan, diskFree(options.mountpoint))
+  if capacity.dropped:
+    Msg("WARN: Insufficient space to copy everything (need %d Mb, have %d Mb)" % ((capacity.chosenbytes + capacity.droppedbytes)/1024/1024, max(0, capacity.free)/1024/1024), 0)
+    for tid in capacity.chosen:
+      track = gpod.itdb_track_id_tree_by_id(trackTree, tid)
+      Msg("INFO: Copying (weight %d): %s (%s)" % (plan.weights[tid], track.title, track.artist), 1)
+    for tid in capacity.dropped:
+      track = gpod.itdb_track_id_tree_by_id(trackTree, tid)
+      Msg("INFO: Not copying (weight %d): %s (%s)" % (plan.weights[tid], track.title, track.artist), 1)
+    Msg("WARN: Will copy %d tracks (%d Mb), leaving out %d (%d Mb)" % (len(capacity.chosen), capacity.chosenbytes/1024/1024, len(capacity.dropped), capacity.droppedbytes/1024/1024), 0)
+  trackstoipod = capacity.chosen
+  numtocopy = len(trackstoipod)
 
   # Find and warn about duplicates
-  filess = []
+  filess = set()
   for tid in copytoipod:
     track = gpod.itdb_track_id_tree_by_id(trackTree, tid)
     if track.ipod_path in filess:
       Msg("WARN: Duplicate track: %s (%s)" % (track.ipod_path, track.title), 1)
-    filess.append(track.ipod_path)
+    filess.add(track.ipod_path)
 
   print "Hit enter to continue..."
   undef = sys.stdin.readline()
@@ -1767,84 +4250,72 @@ def Command_Sync (arg):
   # Delete old tracks from ipod
   delsize = 0
   for itrack in delfromipod:
-    if ipodMap[itrack.id]:
-      itfile = gpod.itdb_filename_on_ipod(itrack)
-      Msg( "DEBUG: Removing %s (%s)" % (itrack.title, itrack.ipod_path), 2)
-      str = "Removing %-70.70s" % itrack.title
-      sys.stdout.write(str.strip() + "\r")
-      sys.stdout.flush()
-      delsize += itrack.size
-      delMap(itrack)
-      extDel(itrack.id, "filename_ipod")
-      deleteTrack(i_itdb, itrack, True)
+    itfile = gpod.itdb_filename_on_ipod(itrack)
+    Msg( "DEBUG: Removing %s (%s)" % (itrack.title, itrack.ipod_path), 2)
+    str = "Removing %-70.70s" % itrack.title
+    sys.stdout.write(str.strip() + "\r")
+    sys.stdout.flush()
+    delsize += itrack.size
+    delMap(itrack)
+    extDel(itrack.id, "filename_ipod")
+    deleteTrack(i_itdb, itrack, True)
 
   fs_free = diskFree(options.mountpoint)
   if dryRun:
     fs_free = fs_free + delsize
 
-  # Copy track to ipod, skip if already there
-  written = []
+  # Copy track to ipod, skip if already there. Files are copied and
+  # artwork extracted by the transfer pool, finished tracks are hooked
+  # into the ipod itdb here as they come back.
+  xfer = Transfer(options.jobs, journal)
+  journal.start()
+  written = set()
   count = 0
+  copied = 0
   for tid in trackstoipod:
     if tid in written:
       Msg("WARN: Hmm..already wrote track id %d, skipping" % tid, 2)
-    written.append(tid)
+    written.add(tid)
     track = gpod.itdb_track_id_tree_by_id(trackTree, tid)
     count += 1
     tfile = track.ipod_path
     if not os.path.isfile(tfile):
       Msg("WARN: Can't find %s, skipping \n\n" % tfile, 1)
       continue
-    if 0 and fs_free - track.size < 24000000:  # Leave 24Mb free on ipod
-      Msg("WARN: No space left while writing %s" % track.title, 0)
-      break
-    fs_free -= track.size
+    size = diskUsage(capacity.cluster, track.size)
+    if fs_free - size < capacity.reserve:
+      Msg("WARN: No space left while writing %s, skipping" % track.title, 0)
+      continue
+    fs_free -= size
     t2 = gpod.itdb_track_duplicate(track)
     t2.ipod_path = None      # Clear path so libgpod does it for me
     t2.transferred = False   # libgpod only transfers if this is false
-    gpod.itdb_track_add(i_itdb, t2, -1)
-    gpod.itdb_playlist_add_track(gpod.itdb_playlist_mpl(i_itdb), t2, -1)
-    if track.id in podcastlist:
-      gpod.itdb_playlist_add_track(gpod.itdb_playlist_podcasts(i_itdb), t2, -1)
-      Msg("INFO: Added '%s' to podcast playlist" % track.title, 1)
-    if not dryRun:
-      gpod.itdb_cp_track_to_ipod(t2, tfile, None)
-    thumb = thumbfile(track.ipod_path)
-    if thumb:
-      gpod.itdb_track_set_thumbnails(t2, thumb)
-      wthumb = "( +thumb )"
-    else:
-      wthumb = ""
-    Msg( "INFO: Copying: %s (%s) %s (%d/%d)" % (track.title, track.artist, wthumb, count, numtocopy), 1)
-    setMap(track, t2) # Set ipod->local mapping
-    extSet(track.id, "filename_ipod", t2.ipod_path)
-    if not count % 50:
-      Msg("DEBUG: Flushing after 50 tracks..\n", 2)
-      gpod.itdb_spl_update_all(i_itdb)
-      writeItdb("ipod")
+    if not xfer.submit(track, t2):
+      Msg("WARN: Can't find a place on the iPod for %s, skipping" % tfile, 0)
+      continue
+    copied = syncFinished(xfer.finished(False), podcastlist, copied, numtocopy, journal)
     if options.limit > 0 and count >= options.limit:
       Msg("INFO: Stopping after %d tracks (--limit specified)" % count, 1)
       break
+  copied = syncFinished(xfer.finished(True), podcastlist, copied, numtocopy, journal)
+  xfer.close()
 
   Msg( "DEBUG: Updating playlists...", 2)
-  gpod.itdb_spl_update_all(i_itdb)
+  splUpdateAll(i_itdb)
   Msg( "INFO: Writing ITDB and syncing disk..", 1)
   writeItdb("ipod")
+  journal.clear()
   writeExt(False)
   writeMap()
+  tagCache.save()
   if not dryRun:
     Msg( "DEBUG: Backing up iPod itdb...", 2)
-    shutil.copyfile(ipodDbname, os.path.join(dotitdb, "iTunesDB.ipod"))
-  if not dryRun and tmpDir:
-    Msg( "DEBUG: Clearing temporary files...", 2)
-    for file in os.listdir(tmpDir):
-      fl = os.path.join(tmpDir, file)
-      os.unlink(fl)
-    try:
-      os.rmdir(tmpDir)
-    except:
-      0
-      # nothing
+    backup = os.path.join(dotitdb, "iTunesDB.ipod")
+    shutil.copyfile(ipodDbname, backup)
+    # Stamped with the live itdb, so reading it back doesn't hash that
+    writeSnapshot(i_itdb, ipodSnapFile(), ipodDbname, backup)
+    writeSyncMap()
+  artCache.trim()
   gpod.itdb_track_id_tree_destroy(trackTree)
   Msg( "Done!", 1)
   sys.exit(0)
@@ -1917,11 +4388,18 @@ command is one of:
   check                         - Check DB for dangling tracks, dupes, etc
   diff                          - Show tracks which have changed rating,
                                   playcount or playtime on iPod
+  writeext                      - Rehash tracks and write the gtkpod
+                                  extended info file
+  serve                         - Keep the databases loaded and run
+                                  commands given with -d
   update <files|dirs>           - Hunts for tracks in <files|dirs> and
                                   updates database with new info. Useful if
                                   you have a new rip of a track.
+  readertest [iTunesDB|tracks]  - Check the direct iTunesDB reader against
+                                  libgpod and time both
 """
 
+start = time.time()
 parser = OptionParser(usage=usage, version="%prog 1.0")
 parser.add_option("-m", "--mountpoint", dest="mountpoint",
                  default=mountpoint,
@@ -1942,6 +4420,42 @@ parser.add_option("--del-files", action="store_true", dest="deleteFiles",
                  help="With local 'del' command, also delete files")
 parser.add_option("--limit", dest="limit", type="int", default=0,
                  help="Limit to <limit> files when adding/syncing/dumping")
+parser.add_option("-j", "--jobs", dest="jobs", type="int", default=2,
+                 help="Copy up to JOBS tracks at once (sync, dump). "
+                 "Default: %default")
+parser.add_option("--checkpoint", dest="checkpoint", type="int", default=60,
+                 help="Write the iPod itdb at least every CHECKPOINT seconds "
+                 "while syncing. Default: %default")
+parser.add_option("--checkpointmb", dest="checkpointmb", type="int", default=200,
+                 help="Also write it after every CHECKPOINTMB Mb copied. "
+                 "Default: %default")
+parser.add_option("-w", "--weight", dest="weights", action="append",
+                 default=[], metavar="PLAYLIST=WEIGHT",
+                 help="When the iPod is too small, prefer tracks from "
+                 "playlists with higher weights (sync). Default weight: 1")
+parser.add_option("--reserve", dest="reserve", type="int", default=24,
+                 help="Leave RESERVE Mb free on the iPod (sync). "
+                 "Default: %default")
+parser.add_option("--artcache", dest="artcache", type="int", default=100,
+                 help="Keep at most ARTCACHE Mb of extracted artwork. "
+                 "Default: %default")
+parser.add_option("--hardlink", action="store_true", dest="hardlink",
+                 help="Let 'dump' hard link tracks to local files with the "
+                 "same contents where it can't reflink them")
+parser.add_option("--full", action="store_true", dest="full",
+                 help="With 'check', verify every file, not just changed ones")
+parser.add_option("--spl", dest="spl", default="gpod",
+                 type="choice", choices=["auto", "gpod", "check"],
+                 help="Evaluate smart playlists with libgpod (gpod), "
+                 "natively where possible (auto, untested against libgpod) "
+                 "or both, reporting differences (check). Default: %default")
+parser.add_option("-d", "--daemon", action="store_true", dest="daemon",
+                 help="Run the command in 'podtool serve' if it's running")
+parser.add_option("--socket", dest="socket",
+                 default=os.path.join(dotitdb, "podtool.sock"),
+                 help="Socket 'serve' listens on. Default: %default")
+parser.add_option("--timings", action="store_true", dest="timings",
+                 help="Report where startup time went, on stderr")
 parser.add_option("-v", "--verbose", action="store_true",
                  dest="verbose", help="Verbose output")
 parser.add_option("-q", "--quiet", action="store_true",
@@ -1951,41 +4465,76 @@ parser.add_option("-f", "--force", action="store_true",
 parser.add_option("-n", "--dry-run", action="store_true",
                  dest="dryrun", help="Dry run, don't actually write anything.")
 (options, args) = parser.parse_args()
+timing("parse options", start)
+if options.timings:
+  atexit.register(reportTimings)
 
 if len(args) < 1:
   showhelp()
 
-verbose = 1
-newItdb = False
-if options.quiet: verbose = 0
-if options.verbose: verbose = 2
+# Sets the globals derived from options
+def applyOptions():
+  global verbose
+  global newItdb
+  global dryRun
+  verbose = 1
+  newItdb = False
+  if options.quiet: verbose = 0
+  if options.verbose: verbose = 2
+  dryRun = options.dryrun
+  if dryRun: Msg("INFO: -n set, NOT writing anything.", 2)
 
-dryRun = options.dryrun
-if dryRun: Msg("INFO: -n set, NOT writing anything.", 2)
+applyOptions()
 
 ipodMap = {}
-extInfo = {}
-tmpDir = None
-
-# Python cookbook, 1.7
-
-if args[0] == "sync": Command_Sync(args)
-if args[0] == "update": Command_Update(args)
-
-n = 0
-if args[0] == "ipod": n += 1
-if len(args) < n: showhelp()
-if args[n] == "dump": Command_Dump()
-if args[n] == "add": Command_Add(args)
-if args[n][0:3] == "del": Command_Del(args)
-if args[n] == "list": Command_List(args)
-if args[n] == "makemap": Command_Makemap()
-if args[n] == "check": Command_Check(args)
-if args[n] == "eval": Command_Evaluate(args)
-if args[n] == "diff": Command_Diff(args)
-if args[n] == "fixart": Command_Fixart(args)
-if args[n] == "playlist": Command_Playlist(args)
-if args[n] == "info": Command_Info(args)
-if args[n] == "writeext": Command_wrExt(args)
-showhelp()
+extStore = ExtStore(options.dbname + ".ext")
+extInfo = extStore.records
+mapStore = MapStore()
+tagCache = TagCache()
+hashCache = HashCache(options.jobs)
+digestCache = DigestCache()
+artCache = ArtCache(options.artcache * 1024 * 1024)
+
+# Commands only run against the local db
+localCommands = {
+  "sync": Command_Sync,
+  "update": Command_Update,
+  "readertest": Command_Readertest,
+}
+# Commands which may be prefixed with "ipod"
+commands = {
+  "dump": lambda arg: Command_Dump(),
+  "add": Command_Add,
+  "del": Command_Del,
+  "list": Command_List,
+  "makemap": lambda arg: Command_Makemap(),
+  "check": Command_Check,
+  "eval": Command_Evaluate,
+  "diff": Command_Diff,
+  "fixart": Command_Fixart,
+  "playlist": Command_Playlist,
+  "info": Command_Info,
+  "writeext": Command_wrExt,
+}
+
+def runCommand(args):
+  if localCommands.has_key(args[0]):
+    localCommands[args[0]](args)
+  n = 0
+  if args[0] == "ipod": n += 1
+  if len(args) <= n: showhelp()
+  command = args[n]
+  if command[0:3] == "del": command = "del"
+  if commands.has_key(command):
+    commands[command](args)
+  showhelp()
+
+timing("startup", startTime)
+if args[0] == "serve":
+  Command_Serve(args)
+if options.daemon:
+  code = sendToDaemon(sys.argv[1:])
+  if code is not None:
+    sys.exit(code)
+runCommand(args)
 